@@ -3,8 +3,10 @@
 '''
 a module for reliable block data sending over UDP
 
-NOTE: This module should only be used on private networks - it takes
-no account of network congestion.
+NOTE: This module should only be used on private networks - by default it
+takes no account of network congestion. A DelayRateControl can be passed
+as rate_control to adapt the send rate to the link. Extra links can be
+added with add_path(), chunks are then striped across all of them.
 
 The protocol is designed to work well with large amounts of packet loss, while
 using a fixed maximum bandwidth. The actual send bandwidth scales closely
@@ -20,16 +22,189 @@ May 2012
 released under the GNU GPL v3 or later
 '''
 
-import socket, select, os, random, time, random, struct, binascii
+import socket, select, os, random, time, random, struct, binascii, re, collections, heapq, bisect
+import ctypes, ctypes.util, errno, threading, zlib, bz2, mmap, json
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 # packet types - first byte of a packet
 PKT_ACK = 0
 PKT_COMPLETE = 1
 PKT_CHUNK = 2
+PKT_PARITY = 3
+PKT_CHUNK_CODEC = 4
+PKT_SACK = 5
+PKT_MULTI = 6
+PKT_CANCEL = 7
+PKT_PARITY_CODEC = 8
+
+# packet type names, as used by BlockSenderStats
+_PKT_NAMES = ['ack', 'complete', 'chunk', 'parity', 'chunk_codec', 'sack', 'multi', 'cancel',
+              'parity_codec']
 
 # size of packet type plus crc32
 PACKET_HEADER_SIZE = 5
 
+# largest UDP datagram we can receive
+MAX_PACKET_SIZE = 65536
+
+# linux UDP generic receive/segmentation offload, not exported by the socket module
+_SOL_UDP = 17
+_UDP_SEGMENT = 103
+_UDP_GRO = 104
+
+# largest UDP payload that can be sent as one GSO super-packet, and the
+# maximum number of segments the kernel accepts in one
+_GSO_MAX_SIZE = 65507
+_GSO_MAX_SEGMENTS = 64
+
+# linux path MTU discovery socket options, not exported by the socket module
+_IP_MTU_DISCOVER = 10
+_IP_PMTUDISC_DO = 2
+_IP_MTU = 14
+
+# size of the IPv4 and UDP headers
+_UDP_IP_OVERHEAD = 28
+
+# chunk size tuning: smallest chunk size tried, the step between the sizes
+# tried, how many chunk outcomes to measure a size over, how many
+# evaluations a measurement is trusted for and how often to probe the path
+# MTU, in seconds. Probes go to the discard port of the destination host
+_MIN_AUTO_CHUNK = 256
+_AUTO_CHUNK_STEP = 1.25
+_AUTO_CHUNK_SAMPLES = 200
+_AUTO_CHUNK_MEMORY = 8
+_MTU_PROBE_INTERVAL = 5.0
+_MTU_PROBE_PORT = 9
+
+# upper bounds in seconds of the histogram buckets of BlockSenderStats. A
+# final bucket counts anything larger
+_RTT_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+_BLOCK_TIME_BUCKETS = [0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 1800]
+
+# how many recently completed blocks BlockSenderStats lists
+_STATS_RECENT = 20
+
+# bitmap helpers for BlockSenderSet
+_FULL_BYTE = bytearray(b'\xff')
+_NOT_CLEAR_BYTE = re.compile(b'[^\x00]')
+_NOT_FULL_BYTE = re.compile(b'[^\xff]')
+_LOWEST_BIT = [0] + [(i & -i).bit_length() - 1 for i in range(1, 256)]
+_POPCOUNT = bytes(bytearray(bin(i).count('1') for i in range(256)))
+
+# version of the PKT_SACK bitmap ack encoding, and its flags
+_SACK_VERSION = 1
+_SACK_ZLIB = 1
+
+# bitmaps of at least this many bytes are tried with zlib compression
+_SACK_COMPRESS_SIZE = 32
+
+# payload compression codecs, the codec id is sent in PKT_CHUNK_CODEC and
+# PKT_PARITY_CODEC packets
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+
+_CODEC_IDS = { 'zlib' : CODEC_ZLIB, 'bz2' : CODEC_BZ2, 'lzma' : CODEC_LZMA }
+
+# payloads starting with these are already compressed (JPEG, PNG, gzip, zip, bz2, xz)
+_COMPRESSED_MAGIC = (b'\xff\xd8\xff', b'\x89PNG', b'\x1f\x8b', b'PK\x03\x04', b'BZh', b'\xfd7zXZ')
+
+# the compression heuristic compresses this many bytes from a few places in a
+# block, and only compresses the block if the sample shrinks below the ratio
+_SAMPLE_SIZE = 4096
+_SAMPLE_RATIO = 0.9
+
+try:
+    # python2 mmap objects only support the old buffer interface
+    _old_buffer = buffer
+except NameError:
+    _old_buffer = None
+
+
+def _xor_buffers(bufs, size):
+    '''return the XOR of a list of buffers, each zero padded to size bytes'''
+    v = 0
+    for b in bufs:
+        if len(b):
+            v ^= int(binascii.hexlify(b), 16) << (8*(size - len(b)))
+    return binascii.unhexlify('%0*x' % (2*size, v))
+
+
+def _tobytes(buf):
+    '''return the contents of a buffer object as bytes'''
+    if isinstance(buf, bytes):
+        return buf
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return bytes(bytearray(buf))
+
+def _compress(data, codec, level):
+    '''compress data with a codec id, level None meaning the codec default'''
+    if codec == CODEC_ZLIB:
+        if level is None:
+            return zlib.compress(data)
+        return zlib.compress(data, level)
+    if codec == CODEC_BZ2:
+        if level is None:
+            return bz2.compress(data)
+        return bz2.compress(data, level)
+    if codec == CODEC_LZMA and lzma is not None:
+        return lzma.compress(data, preset=level)
+    raise BlockSenderException('unsupported codec %u' % codec)
+
+
+def _decompress(data, codec):
+    '''decompress data compressed with a codec id'''
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_BZ2:
+        return bz2.decompress(data)
+    if codec == CODEC_LZMA and lzma is not None:
+        return lzma.decompress(data)
+    raise BlockSenderException('unsupported codec %u' % codec)
+
+
+def _worth_compressing(data):
+    '''guess from its header and a sample whether compressing data will
+    save enough to be worth the CPU time'''
+    head = _tobytes(data[:8])
+    for magic in _COMPRESSED_MAGIC:
+        if head.startswith(magic):
+            return False
+    if len(data) <= 3*_SAMPLE_SIZE:
+        sample = data
+    else:
+        # the start, middle and end of the block
+        mid = (len(data) - _SAMPLE_SIZE) // 2
+        sample = b''.join([_tobytes(data[:_SAMPLE_SIZE]),
+                           _tobytes(data[mid:mid+_SAMPLE_SIZE]),
+                           _tobytes(data[-_SAMPLE_SIZE:])])
+    return len(zlib.compress(sample, 1)) < len(sample) * _SAMPLE_RATIO
+
+
+def _spool_file(path, size):
+    '''create a file of size bytes and return a shared memory map of it'''
+    f = open(path, 'w+b')
+    try:
+        f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+    finally:
+        # the map keeps its own reference to the file
+        f.close()
+
+
 class BlockSenderException(Exception):
     '''block sender error class'''
     def __init__(self, msg):
@@ -39,67 +214,131 @@ class BlockSenderException(Exception):
 class BlockSenderSet:
     '''hold a set of chunk IDs for an identifier.
     This object is sent as a PKT_ACK to
-    acknowledge receipt of data'''
+    acknowledge receipt of data, or as a PKT_SACK holding
+    a window of the bitmap itself, see pack_bitmap()
+
+    The chunk IDs are held as a bitmap, one bit per chunk, so that
+    extents can be generated by skipping whole bytes of set or clear
+    bits rather than by sorting the IDs'''
     def __init__(self, id, num_chunks, mss):
         self.id = id
         self.num_chunks = num_chunks
-        self.chunks = set()
+        self.bits = bytearray((num_chunks + 7) // 8)
+        self.count = 0
         self.timestamp = 0
         self.format = '<QHd'
         self.header_size = struct.calcsize(self.format)
         self.first_missing = 0
         self.mss = mss
         self.last_sent = 0
+        self.sack_format = '<BQHdHB'
+        self.sack_header_size = struct.calcsize(self.sack_format)
                 #print("Created %s" % str(self))
 
     def __str__(self):
-        return 'BlockSenderSet<%u/%u>' % (len(self.chunks), self.num_chunks)
+        return 'BlockSenderSet<%u/%u>' % (self.count, self.num_chunks)
+
+    def _next_set(self, pos):
+        '''return the first chunk ID >= pos that is present, or num_chunks'''
+        if pos >= self.num_chunks:
+            return self.num_chunks
+        byte = self.bits[pos >> 3] >> (pos & 7)
+        if byte:
+            return min(pos + _LOWEST_BIT[byte], self.num_chunks)
+        m = _NOT_CLEAR_BYTE.search(self.bits, (pos >> 3) + 1)
+        if m is None:
+            return self.num_chunks
+        i = m.start()
+        return min((i << 3) + _LOWEST_BIT[self.bits[i]], self.num_chunks)
+
+    def _next_clear(self, pos):
+        '''return the first chunk ID >= pos that is missing, or num_chunks'''
+        if pos >= self.num_chunks:
+            return self.num_chunks
+        byte = (~self.bits[pos >> 3] & 0xFF) >> (pos & 7)
+        if byte:
+            return min(pos + _LOWEST_BIT[byte], self.num_chunks)
+        m = _NOT_FULL_BYTE.search(self.bits, (pos >> 3) + 1)
+        if m is None:
+            return self.num_chunks
+        i = m.start()
+        return min((i << 3) + _LOWEST_BIT[~self.bits[i] & 0xFF], self.num_chunks)
+
+    def extents(self, start=0):
+        '''return a list of (first,count) runs of present chunks, starting at chunk start'''
+        extents = []
+        first = self._next_set(start)
+        while first < self.num_chunks:
+            end = self._next_clear(first)
+            extents.append((first, end-first))
+            first = self._next_set(end)
+        return extents
 
     def update_first_missing(self):
         '''update the first_missing field'''
-        while self.first_missing < self.num_chunks:
-            if not self.first_missing in self.chunks:
-                break
-            self.first_missing += 1
+        self.first_missing = self._next_clear(self.first_missing)
+
+    def set_range(self, first, count):
+        '''mark count chunks starting at first as present'''
+        end = min(first + count, self.num_chunks)
+        while first < end and first & 7:
+            self._set(first)
+            first += 1
+        while end > first and end & 7:
+            end -= 1
+            self._set(end)
+        if first < end:
+            old = self.bits[first >> 3:end >> 3]
+            self.count += (end - first) - sum(old.translate(_POPCOUNT))
+            self.bits[first >> 3:end >> 3] = _FULL_BYTE * ((end - first) >> 3)
+
+    def _set(self, chunk_id):
+        '''mark a single chunk as present'''
+        mask = 1 << (chunk_id & 7)
+        if not self.bits[chunk_id >> 3] & mask:
+            self.bits[chunk_id >> 3] |= mask
+            self.count += 1
 
     def add(self, chunk_id, ack_to):
         '''add an extent to the list. This is called when we receive a chunk of data'''
-        self.chunks.add(chunk_id)
+        if chunk_id < self.num_chunks:
+            self._set(chunk_id)
         self.first_missing = ack_to
 
     def update(self, new):
         '''add in new chunks. This is called when we receive an ack packet'''
-        self.chunks.update(new.chunks)
+        for (first, count) in new.extents():
+            self.set_range(first, count)
         self.update_first_missing()
 
+    def set_bits(self, bits):
+        '''replace the chunks with a bitmap, e.g. one from a journal or an ack packet'''
+        if len(bits) != len(self.bits):
+            raise BlockSenderException('bitmap length %u does not match %u' % (len(bits), len(self.bits)))
+        self.bits = bytearray(bits)
+        if self.num_chunks & 7:
+            # ignore bits past the last chunk
+            self.bits[-1] &= (1 << (self.num_chunks & 7)) - 1
+        self.count = sum(self.bits.translate(_POPCOUNT))
+        self.first_missing = self._next_clear(0)
+
     def present(self, chunk_id):
         '''see if a chunk_id is present in the chunks'''
-        return chunk_id in self.chunks
+        if chunk_id >= self.num_chunks:
+            return False
+        return bool(self.bits[chunk_id >> 3] & (1 << (chunk_id & 7)))
 
     def complete(self):
         '''return True if the chunks cover the whole set of data'''
-        return len(self.chunks) == self.num_chunks
+        return self.count == self.num_chunks
 
     def started(self):
         '''return True if we have at least one chunk'''
-        return len(self.chunks) > 0
+        return self.count > 0
 
     def pack(self):
         '''return a linearized representation'''
-        chunks = list(self.chunks)
-        chunks.sort()
-        extents = []
-        for i in range(len(chunks)):
-            if chunks[i] < self.first_missing:
-                continue
-            if len(extents) == 0:
-                extents.append((chunks[i], 1))
-                continue
-            (first,count) = extents[-1]
-            if chunks[i] == first+count:
-                extents[-1] = (first, count+1)
-            else:
-                extents.append((chunks[i], 1))
+        extents = self.extents(self.first_missing)
         buf = bytes(struct.pack(self.format, self.id, self.num_chunks, self.timestamp))
         if self.mss:
             max_extents = (self.mss - (len(buf) + PACKET_HEADER_SIZE)) / 2
@@ -127,6 +366,8 @@ class BlockSenderSet:
         if len(buf) < self.header_size:
             raise BlockSenderException('buffer too short')
         (self.id, self.num_chunks, self.timestamp) = struct.unpack_from(self.format, buf)
+        self.bits = bytearray((self.num_chunks + 7) // 8)
+        self.count = 0
         ofs = self.header_size
         if (len(buf) - ofs) % 4 != 0:
             raise BlockSenderException('invalid extents length')
@@ -134,8 +375,121 @@ class BlockSenderSet:
         for i in range(n):
             (first, count) = struct.unpack_from('<HH', buf, ofs)
             ofs += 4
-            for j in range(first, first+count):
-                self.chunks.add(j)
+            self.set_range(first, count)
+
+    def _bitmap_window(self):
+        '''return the byte aligned chunk ID the bitmap window starts at and the
+        bitmap from there to the last present chunk'''
+        start = self.first_missing >> 3
+        return (start << 3, bytes(self.bits[start:].rstrip(b'\x00')))
+
+    def prefer_bitmap(self):
+        '''return True if pack_bitmap() gives a smaller ack than pack(),
+        or the extents would not all fit in the mss'''
+        extents_size = 4 * len(self.extents(self.first_missing))
+        (base, bitmap) = self._bitmap_window()
+        if self.mss and self.header_size + extents_size + PACKET_HEADER_SIZE > self.mss:
+            return True
+        return self.sack_header_size + len(bitmap) < self.header_size + extents_size
+
+    def pack_bitmap(self):
+        '''return a linearized representation for a PKT_SACK. This is a
+        window of the bitmap from the first missing chunk, zlib compressed
+        if that makes it smaller. If the window does not fit in the mss it
+        is truncated, later acks move on as the window fills'''
+        (base, bitmap) = self._bitmap_window()
+        flags = 0
+        if len(bitmap) >= _SACK_COMPRESS_SIZE:
+            compressed = zlib.compress(bitmap)
+            if len(compressed) < len(bitmap):
+                bitmap = compressed
+                flags |= _SACK_ZLIB
+        if self.mss:
+            room = max(self.mss - (self.sack_header_size + PACKET_HEADER_SIZE), 0)
+            if len(bitmap) > room:
+                (base, bitmap) = self._bitmap_window()
+                bitmap = bitmap[:room]
+                flags = 0
+        return struct.pack(self.sack_format, _SACK_VERSION, self.id, self.num_chunks,
+                           self.timestamp, base, flags) + bitmap
+
+    def unpack_bitmap(self, buf):
+        '''unpack a PKT_SACK linearized representation into the object'''
+        if len(buf) < self.sack_header_size:
+            raise BlockSenderException('buffer too short')
+        (version, self.id, self.num_chunks, self.timestamp,
+         base, flags) = struct.unpack_from(self.sack_format, buf)
+        if version != _SACK_VERSION:
+            raise BlockSenderException('unknown sack version %u' % version)
+        if base & 7:
+            raise BlockSenderException('unaligned sack base %u' % base)
+        nbytes = (self.num_chunks + 7) // 8
+        start = min(base >> 3, nbytes)
+        bitmap = _tobytes(buf[self.sack_header_size:])
+        if flags & _SACK_ZLIB and start < nbytes:
+            bitmap = zlib.decompressobj().decompress(bitmap, nbytes - start)
+        bitmap = bitmap[:nbytes - start]
+        self.bits = bytearray(nbytes)
+        self.bits[start:start+len(bitmap)] = bitmap
+        if self.num_chunks & 7 and start + len(bitmap) == nbytes:
+            # ignore bits past the last chunk
+            self.bits[-1] &= (1 << (self.num_chunks & 7)) - 1
+        self.count = sum(self.bits.translate(_POPCOUNT))
+
+
+class BlockSenderSack:
+    '''a BlockSenderSet sent as a PKT_SACK bitmap ack'''
+    def __init__(self, acks):
+        self.acks = acks
+
+    def __str__(self):
+        return 'BlockSenderSack<%s>' % str(self.acks)
+
+    def pack(self):
+        '''return a linearized representation'''
+        return self.acks.pack_bitmap()
+
+
+class BlockSenderMulti:
+    '''a PKT_MULTI packet, holding several packets for the same destination,
+    e.g. the acks for a number of blocks. Each is sent as its packet type,
+    length and linearized representation'''
+    def __init__(self, packets=None):
+        if packets is None:
+            packets = []
+        self.packets = packets
+        self.entry_format = '<BH'
+        self.entry_size = struct.calcsize(self.entry_format)
+
+    def __str__(self):
+        return 'BlockSenderMulti<%u>' % len(self.packets)
+
+    def packed_size(self):
+        '''return the length of the linearized representation'''
+        return sum([self.entry_size + len(buf) for (type, buf) in self.packets])
+
+    def pack(self):
+        '''return a linearized representation'''
+        parts = []
+        for (type, buf) in self.packets:
+            parts.append(struct.pack(self.entry_format, type, len(buf)))
+            parts.append(_tobytes(buf))
+        return b''.join(parts)
+
+    def unpack(self, buf):
+        '''unpack a linearized representation into the object. If buf is a
+        memoryview the packets are views on it'''
+        self.packets = []
+        ofs = 0
+        while ofs < len(buf):
+            if len(buf) - ofs < self.entry_size:
+                raise BlockSenderException('truncated multi packet')
+            (type, length) = struct.unpack_from(self.entry_format, buf, ofs)
+            ofs += self.entry_size
+            if length > len(buf) - ofs or type == PKT_MULTI:
+                raise BlockSenderException('invalid multi packet entry')
+            self.packets.append((type, buf[ofs:ofs+length]))
+            ofs += length
 
 
 class BlockSenderComplete:
@@ -156,12 +510,37 @@ class BlockSenderComplete:
 
     def unpack(self, buf):
         '''unpack a linearized representation into the object'''
-        (self.block_id, self.timestamp) = struct.unpack('<Qd', buf)
+        if len(buf) != struct.calcsize('<Qd'):
+            raise BlockSenderException('invalid complete length')
+        (self.block_id, self.timestamp) = struct.unpack_from('<Qd', buf)
+
+
+class BlockSenderCancel:
+    '''a packet to say that the sender has given up on a block, so the
+    receiver can free what it has of it'''
+    def __init__(self, block_id):
+        self.block_id = block_id
+
+    def __str__(self):
+        return 'BlockSenderCancel<%u>' % self.block_id
+
+    def pack(self):
+        '''return a linearized representation'''
+        return bytes(struct.pack('<Q', self.block_id))
+
+    def unpack(self, buf):
+        '''unpack a linearized representation into the object'''
+        if len(buf) != struct.calcsize('<Q'):
+            raise BlockSenderException('invalid cancel length')
+        (self.block_id,) = struct.unpack_from('<Q', buf)
 
 
 class BlockSenderChunk:
-    '''an incoming chunk packet. This is the main data format'''
-    def __init__(self, block_id, size, chunk_id, data, chunk_size, ack_to, timestamp):
+    '''an incoming chunk packet. This is the main data format
+
+    Chunks of a compressed block are sent as PKT_CHUNK_CODEC packets, which
+    add the codec id to the header'''
+    def __init__(self, block_id, size, chunk_id, data, chunk_size, ack_to, timestamp, codec=CODEC_NONE):
         self.block_id = block_id
         self.size = size
         self.chunk_id = chunk_id
@@ -169,7 +548,11 @@ class BlockSenderChunk:
         self.data = data
         self.ack_to = ack_to
         self.timestamp = timestamp
-        self.format = '<QLHHHd'
+        self.codec = codec
+        if codec == CODEC_NONE:
+            self.format = '<QLHHHd'
+        else:
+            self.format = '<QLHHHdB'
         self.header_size = struct.calcsize(self.format)
         if data is not None:
             self.packed_size = len(data) + self.header_size
@@ -182,31 +565,133 @@ class BlockSenderChunk:
 
     def pack(self):
         '''return a linearized representation'''        
-        buf = bytes(struct.pack(self.format, self.block_id, self.size, self.chunk_id,
-                        self.chunk_size, self.ack_to, self.timestamp))
-        buf += bytes(self.data)
-        return buf
+        return b''.join([_tobytes(p) for p in self.pack_parts()])
+
+    def packet_type(self):
+        '''return the packet type to send this chunk as'''
+        if self.codec == CODEC_NONE:
+            return PKT_CHUNK
+        return PKT_CHUNK_CODEC
+
+    def pack_parts(self):
+        '''return the linearized representation as a list of buffers. The
+        payload is not copied'''
+        if self.codec == CODEC_NONE:
+            header = struct.pack(self.format, self.block_id, self.size, self.chunk_id,
+                                 self.chunk_size, self.ack_to, self.timestamp)
+        else:
+            header = struct.pack(self.format, self.block_id, self.size, self.chunk_id,
+                                 self.chunk_size, self.ack_to, self.timestamp, self.codec)
+        return [header, self.data]
 
     def unpack(self, buf):
-        '''unpack a linearized representation into the object'''
-        (self.block_id, self.size,
-         self.chunk_id, self.chunk_size, self.ack_to, self.timestamp) = struct.unpack_from(self.format, buf, offset=0)
-        self.data = bytes(buf[self.header_size:])
+        '''unpack a linearized representation into the object. If buf is a
+        memoryview the data is a view on it, not a copy'''
+        fields = struct.unpack_from(self.format, buf, offset=0)
+        (self.block_id, self.size, self.chunk_id, self.chunk_size, self.ack_to, self.timestamp) = fields[:6]
+        if len(fields) > 6:
+            self.codec = fields[6]
+        self.data = buf[self.header_size:]
+
+
+class BlockSenderParity:
+    '''a forward error correction packet. The data is the XOR of count
+    chunks starting at chunk first, each padded to chunk_size. A receiver
+    missing exactly one chunk of the group can rebuild it from the others.
+
+    Parity of a compressed block is sent as a PKT_PARITY_CODEC packet, which
+    carries the codec id, so that a block rebuilt without any of its chunks
+    arriving is still decompressed'''
+    def __init__(self, block_id, size, first, count, data, chunk_size, ack_to, timestamp,
+                 codec=CODEC_NONE):
+        self.block_id = block_id
+        self.size = size
+        self.first = first
+        self.count = count
+        self.chunk_size = chunk_size
+        self.data = data
+        self.ack_to = ack_to
+        self.timestamp = timestamp
+        self.codec = codec
+        if codec == CODEC_NONE:
+            self.format = '<QLHHHdB'
+        else:
+            self.format = '<QLHHHdBB'
+        self.header_size = struct.calcsize(self.format)
+        if data is not None:
+            self.packed_size = len(data) + self.header_size
+        else:
+            self.packed_size = 0
+
+    def __str__(self):
+        return 'BlockSenderParity<%u,%u,%u,%u>' % (self.block_id, self.first, self.count, self.size)
+
+    def pack(self):
+        '''return a linearized representation'''
+        return b''.join([_tobytes(p) for p in self.pack_parts()])
+
+    def packet_type(self):
+        '''return the packet type to send this parity as'''
+        if self.codec == CODEC_NONE:
+            return PKT_PARITY
+        return PKT_PARITY_CODEC
+
+    def pack_parts(self):
+        '''return the linearized representation as a list of buffers'''
+        if self.codec == CODEC_NONE:
+            header = struct.pack(self.format, self.block_id, self.size, self.first,
+                                 self.chunk_size, self.ack_to, self.timestamp, self.count)
+        else:
+            header = struct.pack(self.format, self.block_id, self.size, self.first,
+                                 self.chunk_size, self.ack_to, self.timestamp, self.count, self.codec)
+        return [header, self.data]
+
+    def unpack(self, buf):
+        '''unpack a linearized representation into the object. If buf is a
+        memoryview the data is a view on it, not a copy'''
+        fields = struct.unpack_from(self.format, buf, offset=0)
+        (self.block_id, self.size, self.first, self.chunk_size,
+         self.ack_to, self.timestamp, self.count) = fields[:7]
+        if len(fields) > 7:
+            self.codec = fields[7]
+        self.data = buf[self.header_size:]
 
 
 class BlockSenderBlock:
     '''the state of an incoming or outgoing block'''
-    def __init__(self, block_id, size, chunk_size, dest, mss, data=None, callback=None, priority=0):
+    def __init__(self, block_id, size, chunk_size, dest, mss, data=None, callback=None, priority=0,
+                 zero_copy=False, fec=0, codec=CODEC_NONE, spool_path=None):
         self.block_id = block_id
         self.size = size
         self.chunk_size = chunk_size
         self.num_chunks = (self.size + (chunk_size-1)) // chunk_size
         #FIXME mss == where the acks need to go?
         self.acks = BlockSenderSet(block_id, self.num_chunks, mss)
+        self.view = None
         if data is not None:
-            self.data = bytearray(data)
+            if not zero_copy and not isinstance(data, bytes):
+                # the caller may modify a mutable buffer after send()
+                data = bytearray(data)
+            self.data = data
+            try:
+                self.view = memoryview(data)
+            except TypeError:
+                if _old_buffer is None:
+                    raise
+        elif spool_path is not None:
+            # incoming block received straight into a memory mapped file
+            if os.path.exists(spool_path) and os.path.getsize(spool_path) == size:
+                # resuming a partly received block
+                f = open(spool_path, 'r+b')
+                try:
+                    self.data = mmap.mmap(f.fileno(), size)
+                finally:
+                    f.close()
+            else:
+                self.data = _spool_file(spool_path, size)
         else: #incoming packet?
             self.data = bytearray(size)#bytearray(size)
+        self.spool_path = spool_path
 
         self.data_length = 0
         self.num_chunks_recv = 0    
@@ -217,15 +702,54 @@ class BlockSenderBlock:
         self.next_chunk = 0
         self.priority = priority
         self.sends = 0
-        self.chunk_send_times = {}
+        # (send_time, chunk_id, path) for chunks awaiting an ack, in send order. As
+        # all chunks share the same retransmit timeout this is also expiry order
+        self.retransmit = collections.deque()
+        # the path the last chunk of an incoming block arrived on, acks go back on it
+        self.path = None
+        # outgoing: chunks per parity group and the first chunk of each group
+        # whose parity is waiting to be sent.
+        # incoming: group size and first chunk -> (count, parity data)
+        self.fec = fec
+        self.parity_pending = collections.deque()
+        self.parity = {}
+        self.queued = False
+        # the channel the block is sent on, see BlockSender.add_channel()
+        self.channel = None
+        # outgoing: time after which the block is dropped, and the function
+        # to call when it is
+        self.deadline = None
+        self.expired_callback = None
+        # when the block was queued to send or its first packet arrived
+        self.create_time = None
+        # the codec the block data is compressed with
+        self.codec = codec
+        # incoming: number of chunks received without a gap from the start
+        self.contiguous = 0
+        # incoming: when the last chunk arrived, the highest chunk seen, the
+        # number of chunks not yet acked and when an ack is due
+        self.recv_time = 0
+        self.last_chunk = -1
+        self.unacked = 0
+        self.ack_due = 0
+        # outgoing: the BlockSenderChunkTuner that chose the chunk size
+        self.tuner = None
+        # outgoing: resumed from a journal, the acks saved before the
+        # restart have not been confirmed by the receiver yet
+        self.resumed = False
         #print("Created %s" % str(self))
 
     def __str__(self):
         return 'BlockSenderBlock<%u,%u,%u,%u>' % (self.block_id,self.size,self.chunk_size,self.num_chunks)
 
     def chunk(self, chunk_id):
-        '''return data for a chunk'''
+        '''return data for a chunk. For outgoing blocks this is a view on the
+        block data rather than a copy'''
         start = chunk_id*self.chunk_size
+        if self.view is not None:
+            return self.view[start:start+self.chunk_size]
+        if _old_buffer is not None and not isinstance(self.data, bytearray):
+            return _old_buffer(self.data, start, self.chunk_size)
         return self.data[start:start+self.chunk_size]        
 
     def complete(self):
@@ -233,6 +757,937 @@ class BlockSenderBlock:
         return self.acks.complete()
 
 
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+class _cmsghdr(ctypes.Structure):
+    _fields_ = [('cmsg_len', ctypes.c_size_t),
+                ('cmsg_level', ctypes.c_int),
+                ('cmsg_type', ctypes.c_int)]
+
+
+class BlockSenderBatch:
+    '''send a batch of UDP packets with one sendmmsg() system call (linux only)
+
+    Runs of equal sized packets to the same destination are sent as a
+    single UDP_SEGMENT super-packet which the kernel or NIC splits into
+    datagrams. Packets are copied into a preallocated buffer, which from
+    python is cheaper than looking up the address of each buffer, the
+    saving is in system calls and per datagram kernel work. Raises
+    BlockSenderException if batching is not supported, the caller should
+    then fall back to sending packet by packet'''
+    def __init__(self, sock, max_packets=64):
+        if not hasattr(sock, 'fileno'):
+            raise BlockSenderException('batched send needs a real socket')
+        libname = ctypes.util.find_library('c')
+        if libname is None:
+            raise BlockSenderException('no C library for sendmmsg')
+        libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(libc, 'sendmmsg'):
+            raise BlockSenderException('sendmmsg not available')
+        self.sendmmsg = libc.sendmmsg
+        self.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+        self.sendmmsg.restype = ctypes.c_int
+        self.fd = sock.fileno()
+        self.max_packets = max_packets
+        self.size = max_packets * MAX_PACKET_SIZE
+        self.pool = bytearray(self.size)
+        self.pool_base = ctypes.addressof((ctypes.c_char * self.size).from_buffer(self.pool))
+        self.iovs = (_iovec * max_packets)()
+        self.msgs = (_mmsghdr * max_packets)()
+        for i in range(max_packets):
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        # one UDP_SEGMENT control message per GSO super-packet
+        cmsg_len = ctypes.sizeof(_cmsghdr) + 2
+        self.cmsg_space = (cmsg_len + 7) & ~7
+        self.control = (ctypes.c_char * (self.cmsg_space * max_packets))()
+        for i in range(max_packets):
+            hdr = _cmsghdr.from_buffer(self.control, i*self.cmsg_space)
+            hdr.cmsg_len = cmsg_len
+            hdr.cmsg_level = _SOL_UDP
+            hdr.cmsg_type = _UDP_SEGMENT
+        self.addrs = {}
+
+    def _sockaddr(self, dest):
+        '''return a cached sockaddr_in for a (host,port) tuple'''
+        addr = self.addrs.get(dest, None)
+        if addr is None:
+            (host, port) = dest
+            raw = struct.pack('=H', socket.AF_INET) + struct.pack('>H', port) + \
+                  socket.inet_aton(socket.gethostbyname(host)) + bytes(bytearray(8))
+            addr = ctypes.create_string_buffer(raw, len(raw))
+            self.addrs[dest] = addr
+        return addr
+
+    def send(self, packets):
+        '''send a list of (parts, dest) packets, where parts is a list of buffers.
+        Returns the number sent, which is fewer than given if the socket
+        buffer filled'''
+        i = 0
+        while i < len(packets):
+            (i, full) = self._send_some(packets, i)
+            if full:
+                break
+        return i
+
+    def _send_some(self, packets, first):
+        '''send as many packets as fit in the pool, starting at first. Returns
+        (i, full) where i is the index of the first packet not sent and full
+        is True if the socket buffer filled'''
+        ofs = 0
+        nmsgs = 0
+        i = first
+        # index of the first packet after each message
+        ends = []
+        while i < len(packets) and nmsgs < self.max_packets:
+            (parts, dest) = packets[i]
+            plen = sum([len(p) for p in parts])
+            if ofs + plen > self.size:
+                break
+            msg = self.msgs[nmsgs]
+            start = ofs
+            for p in parts:
+                self.pool[ofs:ofs+len(p)] = p
+                ofs += len(p)
+            i += 1
+            segments = 1
+            # append following packets of the same size to this super-packet.
+            # The last segment may be shorter
+            while (i < len(packets) and segments < _GSO_MAX_SEGMENTS and
+                   packets[i][1] == dest and (ofs - start) + plen <= _GSO_MAX_SIZE):
+                nparts = packets[i][0]
+                nlen = sum([len(p) for p in nparts])
+                if nlen > plen or ofs + nlen > self.size:
+                    break
+                for p in nparts:
+                    self.pool[ofs:ofs+len(p)] = p
+                    ofs += len(p)
+                i += 1
+                segments += 1
+                if nlen < plen:
+                    break
+            self.iovs[nmsgs].iov_base = self.pool_base + start
+            self.iovs[nmsgs].iov_len = ofs - start
+            addr = self._sockaddr(dest)
+            msg.msg_hdr.msg_name = ctypes.addressof(addr)
+            msg.msg_hdr.msg_namelen = len(addr)
+            if segments > 1:
+                ctypes.memmove(ctypes.addressof(self.control) + nmsgs*self.cmsg_space + ctypes.sizeof(_cmsghdr),
+                               struct.pack('=H', plen), 2)
+                msg.msg_hdr.msg_control = ctypes.addressof(self.control) + nmsgs*self.cmsg_space
+                msg.msg_hdr.msg_controllen = self.cmsg_space
+            else:
+                msg.msg_hdr.msg_control = None
+                msg.msg_hdr.msg_controllen = 0
+            nmsgs += 1
+            ends.append(i)
+        if nmsgs == 0:
+            # a packet too large for the pool
+            return (first + 1, False)
+        sent = 0
+        while sent < nmsgs:
+            ret = self.sendmmsg(self.fd, ctypes.byref(self.msgs[sent]), nmsgs - sent, 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # socket buffer full
+                    if sent == 0:
+                        return (first, True)
+                    return (ends[sent-1], True)
+                if err == errno.EINTR:
+                    continue
+                raise BlockSenderException('sendmmsg failed: %s' % os.strerror(err))
+            sent += ret
+        return (i, False)
+
+
+class BlockSenderChunkTuner:
+    '''chooses the chunk size for new blocks to one destination
+
+    Chunks are kept small enough to fit in the path MTU, which is found
+    by sending "don't fragment" probes to the discard port of the
+    destination host and asking the kernel what it learnt. Within that,
+    the chunk size is hill climbed along a ladder of sizes, measuring
+    the loss rate of each and keeping the one with the best ratio of
+    payload delivered to bytes sent. The receiver needs no changes as
+    the chunk size is in every chunk header
+
+    dest:        (host,port) tuple
+    chunk_size:  chunk size to start with
+    header_size: bytes sent per chunk on top of the payload, including
+                 the IP and UDP headers
+    probe_mtu:   probe the path MTU. Should be False when the chunks don't go
+                 over the host's UDP stack, e.g. on an emulated network (default True)
+    '''
+    def __init__(self, dest, chunk_size, header_size, probe_mtu=True):
+        self.dest = dest
+        self.header_size = header_size
+        self.mtu = None
+        self.sock = None
+        self.last_probe = 0
+        # size -> [outcomes, losses] for sizes being measured
+        self.stats = {}
+        # size -> (efficiency, evaluation number)
+        self.efficiency = {}
+        self.evaluations = 0
+        self.sizes = []
+        self.index = 0
+        self._set_max(65535)
+        self.index = self._nearest(chunk_size)
+        if not probe_mtu:
+            return
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IP, _IP_MTU_DISCOVER, _IP_PMTUDISC_DO)
+            self.sock.connect((dest[0], _MTU_PROBE_PORT))
+            self.sock.setblocking(False)
+        except socket.error:
+            self.sock = None
+
+    def __str__(self):
+        return 'BlockSenderChunkTuner<%s,%u,%s>' % (str(self.dest), self.chunk_size(), str(self.mtu))
+
+    def _set_max(self, max_chunk):
+        '''set the largest chunk size to try, rebuilding the ladder of sizes'''
+        current = None
+        if self.sizes:
+            current = self.chunk_size()
+        max_chunk = max(min(max_chunk, 65535, _GSO_MAX_SIZE - self.header_size + _UDP_IP_OVERHEAD),
+                        _MIN_AUTO_CHUNK)
+        sizes = []
+        size = float(max_chunk)
+        while size >= _MIN_AUTO_CHUNK:
+            sizes.insert(0, int(size))
+            size /= _AUTO_CHUNK_STEP
+        self.sizes = sizes
+        if current is not None:
+            self.index = self._nearest(current)
+
+    def _nearest(self, chunk_size):
+        '''return the index of the largest size no bigger than chunk_size'''
+        i = 0
+        while i+1 < len(self.sizes) and self.sizes[i+1] <= chunk_size:
+            i += 1
+        return i
+
+    def chunk_size(self):
+        '''return the chunk size to use for a new block'''
+        return self.sizes[self.index]
+
+    def chunk_lost(self, chunk_size):
+        '''record a chunk of this size whose ack timed out'''
+        self._outcome(chunk_size, 1)
+
+    def chunk_delivered(self, chunk_size):
+        '''record a chunk of this size that was acked'''
+        self._outcome(chunk_size, 0)
+
+    def _outcome(self, chunk_size, lost):
+        s = self.stats.setdefault(chunk_size, [0, 0])
+        s[0] += 1
+        s[1] += lost
+        if chunk_size == self.chunk_size() and s[0] >= _AUTO_CHUNK_SAMPLES:
+            self._evaluate()
+
+    def _evaluate(self):
+        '''score the current size and move to a better or unmeasured neighbour'''
+        size = self.chunk_size()
+        (count, lost) = self.stats.pop(size)
+        self.evaluations += 1
+        self.efficiency[size] = ((1.0 - lost / float(count)) * size / (size + self.header_size),
+                                 self.evaluations)
+        best = self.index
+        unmeasured = None
+        for i in [self.index+1, self.index-1]:
+            if i < 0 or i >= len(self.sizes):
+                continue
+            known = self.efficiency.get(self.sizes[i], None)
+            if known is None or known[1] + _AUTO_CHUNK_MEMORY < self.evaluations:
+                if unmeasured is None:
+                    unmeasured = i
+            elif known[0] > self.efficiency[self.sizes[best]][0]:
+                best = i
+        if best == self.index and unmeasured is not None:
+            # better than the neighbours we know about, try one we don't
+            best = unmeasured
+        self.index = best
+
+    def probe(self, tnow):
+        '''every few seconds send a path MTU probe and check what the kernel
+        knows about the path MTU'''
+        if self.sock is None or tnow - self.last_probe < _MTU_PROBE_INTERVAL:
+            return
+        self.last_probe = tnow
+        try:
+            mtu = self.sock.getsockopt(socket.IPPROTO_IP, _IP_MTU)
+            # a probe of the MTU we believe in. If a router on the path can't
+            # take it the kernel hears about it and lowers its path MTU
+            self.sock.send(bytearray(mtu - _UDP_IP_OVERHEAD))
+        except socket.error:
+            pass
+        try:
+            mtu = self.sock.getsockopt(socket.IPPROTO_IP, _IP_MTU)
+        except socket.error:
+            return
+        if mtu != self.mtu:
+            self.mtu = mtu
+            self._set_max(mtu - self.header_size)
+
+
+class BlockSenderHistory:
+    '''a bounded set of recently completed block IDs. Once more than
+    maxlen are held the least recently used ID is forgotten'''
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.ids = collections.OrderedDict()
+
+    def __contains__(self, block_id):
+        return block_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, block_id):
+        '''remember a completed block ID'''
+        self.ids.pop(block_id, None)
+        self.ids[block_id] = True
+        while len(self.ids) > self.maxlen:
+            self.ids.popitem(last=False)
+
+    def hit(self, block_id):
+        '''return True if block_id is held, marking it as recently used.
+        A block whose chunks are still arriving is not forgotten'''
+        if block_id not in self.ids:
+            return False
+        self.add(block_id)
+        return True
+
+
+class BlockSenderStats:
+    '''counters kept by a BlockSender, see BlockSender.get_stats()
+
+    The counters are plain attributes that are bumped as packets are sent
+    and received. Per packet type counts are lists indexed by packet type,
+    and histograms are lists of bucket counts, see _RTT_BUCKETS and
+    _BLOCK_TIME_BUCKETS'''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''zero all the counters'''
+        ntypes = len(_PKT_NAMES)
+        self.packets_sent = [0] * ntypes
+        self.bytes_sent = [0] * ntypes
+        self.packets_recv = [0] * ntypes
+        self.bytes_recv = [0] * ntypes
+        self.chunks_sent = 0
+        self.retransmits = 0
+        self.chunks_recv = 0
+        self.dup_chunks = 0
+        self.recovered_chunks = 0
+        self.crc_errors = 0
+        self.bad_packets = 0
+        self.send_errors = 0
+        self.recv_errors = 0
+        self.blocks_queued = 0
+        self.blocks_sent = 0
+        self.blocks_received = 0
+        self.blocks_expired = 0
+        self.blocks_cancelled = 0
+        self.rtt_hist = [0] * (len(_RTT_BUCKETS) + 1)
+        self.send_time_hist = [0] * (len(_BLOCK_TIME_BUCKETS) + 1)
+        self.recv_time_hist = [0] * (len(_BLOCK_TIME_BUCKETS) + 1)
+        # (block_id, size, seconds, sends) of the last few blocks sent
+        self.recent_sends = collections.deque(maxlen=_STATS_RECENT)
+
+    def rtt(self, rtt):
+        '''record an ack round trip time'''
+        self.rtt_hist[bisect.bisect_left(_RTT_BUCKETS, rtt)] += 1
+
+    def block_sent(self, blk, seconds):
+        '''record an outgoing block that took seconds from send() to the final ack'''
+        self.blocks_sent += 1
+        self.send_time_hist[bisect.bisect_left(_BLOCK_TIME_BUCKETS, seconds)] += 1
+        self.recent_sends.append((blk.block_id, blk.size, seconds, blk.sends))
+
+    def block_received(self, seconds):
+        '''record an incoming block that took seconds from its first packet to completion'''
+        self.blocks_received += 1
+        self.recv_time_hist[bisect.bisect_left(_BLOCK_TIME_BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        '''return the counters as a dict of plain types'''
+        def by_type(counts):
+            return dict([(_PKT_NAMES[i], counts[i]) for i in range(len(counts)) if counts[i]])
+        def hist(bounds, counts):
+            return { 'bounds' : list(bounds), 'counts' : list(counts) }
+        return { 'packets_sent' : by_type(self.packets_sent),
+                 'bytes_sent' : by_type(self.bytes_sent),
+                 'packets_recv' : by_type(self.packets_recv),
+                 'bytes_recv' : by_type(self.bytes_recv),
+                 'chunks_sent' : self.chunks_sent,
+                 'retransmits' : self.retransmits,
+                 'chunks_recv' : self.chunks_recv,
+                 'dup_chunks' : self.dup_chunks,
+                 'recovered_chunks' : self.recovered_chunks,
+                 'crc_errors' : self.crc_errors,
+                 'bad_packets' : self.bad_packets,
+                 'send_errors' : self.send_errors,
+                 'recv_errors' : self.recv_errors,
+                 'blocks_queued' : self.blocks_queued,
+                 'blocks_sent' : self.blocks_sent,
+                 'blocks_received' : self.blocks_received,
+                 'blocks_expired' : self.blocks_expired,
+                 'blocks_cancelled' : self.blocks_cancelled,
+                 'rtt_hist' : hist(_RTT_BUCKETS, self.rtt_hist),
+                 'send_time_hist' : hist(_BLOCK_TIME_BUCKETS, self.send_time_hist),
+                 'recv_time_hist' : hist(_BLOCK_TIME_BUCKETS, self.recv_time_hist),
+                 'recent_sends' : [ { 'block_id' : b, 'size' : s, 'seconds' : t, 'sends' : n }
+                                    for (b, s, t, n) in self.recent_sends ] }
+
+
+class BlockSenderJournal:
+    '''on disk state of the blocks of a BlockSender, so that transfers can
+    resume after a restart. Under the journal directory
+
+    out/<block_id>.json   outgoing block header
+    out/<block_id>.data   outgoing block payload
+    out/<block_id>.acks   outgoing block ack bitmap
+    in/<block_id>.json    incoming block header
+    in/<block_id>.map     incoming block received chunk bitmap
+
+    The payload of incoming blocks is kept in spool files, see
+    BlockSender spool_dir. Bitmaps are saved by save_outgoing() and
+    save_incoming(), and a block is only resumed once its header has
+    been written'''
+    def __init__(self, directory):
+        self.out_dir = os.path.join(directory, 'out')
+        self.in_dir = os.path.join(directory, 'in')
+        for d in [self.out_dir, self.in_dir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def _path(self, directory, block_id, ext):
+        return os.path.join(directory, '%u.%s' % (block_id, ext))
+
+    def _write(self, path, data):
+        '''write a file so that it is either complete or not there'''
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def _read(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _remove(self, directory, block_id, exts):
+        for ext in exts:
+            try:
+                os.unlink(self._path(directory, block_id, ext))
+            except OSError:
+                pass
+
+    def _headers(self, directory, fields=()):
+        '''return the saved block headers in a directory, oldest block_id first.
+        Headers without the integer fields needed to rebuild a block are skipped'''
+        headers = []
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                header = json.loads(self._read(os.path.join(directory, name)).decode('utf-8'))
+            except (IOError, ValueError) as e:
+                continue
+            if self._valid_header(header, fields):
+                headers.append(header)
+        return sorted(headers, key=lambda h: h['block_id'])
+
+    def _valid_header(self, header, fields):
+        '''return True if a loaded header describes a block that can be rebuilt'''
+        try:
+            for name in ('block_id', 'size', 'chunk_size', 'codec') + fields:
+                if int(header[name]) != header[name]:
+                    return False
+            deadline = header.get('deadline', None)
+            if deadline is not None and float(deadline) != deadline:
+                return False
+            return (header['block_id'] >= 0 and header['size'] >= 0 and header['chunk_size'] > 0 and
+                    header['codec'] in (CODEC_NONE, CODEC_ZLIB, CODEC_BZ2, CODEC_LZMA) and
+                    header.get('fec', 0) >= 0 and len(header['dest']) == 2)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return False
+
+    def add_outgoing(self, blk):
+        '''save a newly queued outgoing block'''
+        self._write(self._path(self.out_dir, blk.block_id, 'data'), _tobytes(blk.data))
+        self.save_outgoing_header(blk)
+
+    def save_outgoing_header(self, blk):
+        '''save the header of an outgoing block, e.g. after its deadline changed'''
+        header = { 'block_id' : blk.block_id, 'size' : blk.size, 'chunk_size' : blk.chunk_size,
+                   'dest' : list(blk.dest), 'priority' : blk.priority, 'codec' : blk.codec,
+                   'fec' : blk.fec, 'deadline' : blk.deadline }
+        self._write(self._path(self.out_dir, blk.block_id, 'json'), json.dumps(header).encode('utf-8'))
+
+    def save_outgoing(self, blk):
+        '''save the ack bitmap of an outgoing block'''
+        self._write(self._path(self.out_dir, blk.block_id, 'acks'), bytes(blk.acks.bits))
+
+    def remove_outgoing(self, block_id):
+        '''forget an outgoing block that has completed or been cancelled'''
+        self._remove(self.out_dir, block_id, ['json', 'acks', 'data'])
+
+    def load_outgoing(self):
+        '''return a list of (header, data, bits) for the saved outgoing blocks.
+        The data is a read-only memory map of the saved payload, and bits
+        is None if no acks were saved'''
+        blocks = []
+        for header in self._headers(self.out_dir, ('priority', 'fec')):
+            block_id = header['block_id']
+            try:
+                f = open(self._path(self.out_dir, block_id, 'data'), 'rb')
+                try:
+                    if header['size'] == 0:
+                        data = b''
+                    else:
+                        data = mmap.mmap(f.fileno(), header['size'], access=mmap.ACCESS_READ)
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError) as e:
+                continue
+            try:
+                bits = self._read(self._path(self.out_dir, block_id, 'acks'))
+            except IOError:
+                bits = None
+            blocks.append((header, data, bits))
+        return blocks
+
+    def save_incoming(self, blk):
+        '''save the header and received chunk bitmap of an incoming block, once
+        the chunks it records are on disk. The header is rewritten as the
+        codec may only be learnt after the block was created'''
+        blk.data.flush()
+        self._write(self._path(self.in_dir, blk.block_id, 'map'), bytes(blk.acks.bits))
+        header = { 'block_id' : blk.block_id, 'size' : blk.size, 'chunk_size' : blk.chunk_size,
+                   'dest' : list(blk.dest), 'codec' : blk.codec }
+        self._write(self._path(self.in_dir, blk.block_id, 'json'), json.dumps(header).encode('utf-8'))
+
+    def remove_incoming(self, block_id):
+        '''forget an incoming block that has been delivered'''
+        self._remove(self.in_dir, block_id, ['json', 'map'])
+
+    def load_incoming(self):
+        '''return a list of (header, bits) for the saved incoming blocks'''
+        blocks = []
+        for header in self._headers(self.in_dir):
+            try:
+                bits = self._read(self._path(self.in_dir, header['block_id'], 'map'))
+            except IOError:
+                bits = None
+            blocks.append((header, bits))
+        return blocks
+
+
+class BlockSenderQueue:
+    '''a priority queue of outgoing blocks
+
+    Higher priority blocks come first. Blocks of equal priority are sent
+    earliest deadline first, then in the order they were queued. The queue is a binary heap, removal is
+    lazy and dead entries are dropped when the heap is compacted
+
+    aging: if set, a block is ordered by the time it was queued less aging
+           seconds per priority level, so a low priority block is eventually
+           sent ahead of a steady stream of higher priority ones (default None,
+           strict priority)
+    clock: function returning the current time (default time.time)'''
+    def __init__(self, aging=None, clock=time.time):
+        self.heap = []
+        self.next_seq = 0
+        self.count = 0
+        self.aging = aging
+        self.clock = clock
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.walk()
+
+    def push(self, blk, seq=None):
+        '''add a block to the queue. seq breaks ties between equal keys and
+        defaults to a count of the blocks pushed'''
+        if seq is None:
+            seq = self.next_seq
+            self.next_seq += 1
+        deadline = blk.deadline
+        if deadline is None:
+            deadline = float('inf')
+        if self.aging is None:
+            blk.queue_key = (-blk.priority, deadline, seq)
+        else:
+            blk.queue_key = (self.clock() - blk.priority * self.aging, deadline, seq)
+        blk.queued = True
+        self.count += 1
+        heapq.heappush(self.heap, (blk.queue_key, blk))
+
+    def remove(self, blk):
+        '''remove a block from the queue'''
+        if not blk.queued:
+            return
+        blk.queued = False
+        self.count -= 1
+        if len(self.heap) > 2*self.count + 16:
+            # build a new list rather than modifying the heap in place so
+            # a walk() in progress is not disturbed
+            heap = [e for e in self.heap if e[1].queued]
+            heapq.heapify(heap)
+            self.heap = heap
+
+    def first(self):
+        '''return the block that would be sent first, or None'''
+        for blk in self.walk():
+            return blk
+        return None
+
+    def walk(self):
+        '''yield the queued blocks in send order without modifying the heap.
+        Yielding the first k blocks costs O(k log k)'''
+        heap = self.heap
+        if len(heap) == 0:
+            return
+        frontier = [(heap[0][0], 0)]
+        while frontier:
+            (key, i) = heapq.heappop(frontier)
+            blk = heap[i][1]
+            for j in (2*i+1, 2*i+2):
+                if j < len(heap):
+                    heapq.heappush(frontier, (heap[j][0], j))
+            if blk.queued:
+                yield blk
+
+
+class BlockSenderChannel:
+    '''a logical channel of outgoing blocks, see BlockSender.add_channel()'''
+    def __init__(self, name, weight=1, min_rate=0, aging=None, clock=time.time):
+        if weight <= 0:
+            raise BlockSenderException('channel weight must be positive')
+        self.name = name
+        self.weight = weight
+        self.min_rate = min_rate
+        self.queue = BlockSenderQueue(aging, clock)
+        # bytes this channel may send in the current deficit round robin round,
+        # and whether it has had its quantum for the round
+        self.deficit = 0
+        self.topped = False
+        # bytes owed to the channel to keep it up to min_rate
+        self.min_tokens = 0
+        self.last_time = None
+        self.bytes_sent = 0
+
+    def __repr__(self):
+        return 'BlockSenderChannel(%s weight=%s min_rate=%s queued=%u)' % (
+            self.name, self.weight, self.min_rate, len(self.queue))
+
+
+class BlockSenderChannels:
+    '''the outgoing blocks of all channels. This behaves like a single
+    BlockSenderQueue, walking the blocks of every channel in send order'''
+    def __init__(self, aging=None, clock=time.time):
+        self.aging = aging
+        self.clock = clock
+        self.channels = collections.OrderedDict()
+        self.next_seq = 0
+        # the channel deficit round robin starts from next tick
+        self.drr_next = None
+        self.add('default')
+
+    def add(self, name, weight=1, min_rate=0):
+        '''add a channel, or change the weight and minimum rate of an existing one'''
+        channel = self.channels.get(name, None)
+        if channel is None:
+            channel = BlockSenderChannel(name, weight, min_rate, self.aging, self.clock)
+            self.channels[name] = channel
+        else:
+            if weight <= 0:
+                raise BlockSenderException('channel weight must be positive')
+            channel.weight = weight
+            channel.min_rate = min_rate
+        return channel
+
+    def get(self, name):
+        '''return the named channel'''
+        channel = self.channels.get(name, None)
+        if channel is None:
+            raise BlockSenderException('unknown channel %s' % name)
+        return channel
+
+    def __len__(self):
+        return sum([len(c.queue) for c in self.channels.values()])
+
+    def __iter__(self):
+        return self.walk()
+
+    def push(self, blk):
+        '''add a block to the queue of its channel, the default channel if unset'''
+        if blk.channel is None:
+            blk.channel = self.channels['default']
+        # one sequence across all channels keeps the keys unique for walk()
+        blk.channel.queue.push(blk, self.next_seq)
+        self.next_seq += 1
+
+    def remove(self, blk):
+        '''remove a block from the queue of its channel'''
+        channel = blk.channel
+        if channel is None:
+            return
+        channel.queue.remove(blk)
+        if len(channel.queue) == 0:
+            # an idle channel doesn't keep its share for later
+            channel.deficit = 0
+            channel.topped = False
+            channel.min_tokens = 0
+            channel.last_time = None
+
+    def first(self):
+        '''return the block that would be sent first, or None'''
+        for blk in self.walk():
+            return blk
+        return None
+
+    def walk(self):
+        '''yield the queued blocks of all channels in send order'''
+        queues = [c.queue for c in self.channels.values() if len(c.queue)]
+        if len(queues) == 1:
+            for blk in queues[0].walk():
+                yield blk
+            return
+        walks = [self._keyed(q) for q in queues]
+        for (key, blk) in heapq.merge(*walks):
+            yield blk
+
+    def _keyed(self, q):
+        '''walk a queue yielding (key, block)'''
+        for blk in q.walk():
+            yield (blk.queue_key, blk)
+
+
+class FixedRateControl:
+    '''a rate controller that always sends at the path's bandwidth.
+    This is the default
+
+    A rate controller provides rate(), returning the send rate in bytes/s
+    without changing any state, and update(), called before each send to
+    let the controller adjust its rate, plus on_ack() and on_loss() which
+    are called as acks arrive and as chunks time out waiting for an ack.
+    Each is passed the BlockSenderPath being controlled, a controller must
+    not be shared between paths'''
+    def rate(self, path, tnow):
+        '''return the current send rate in bytes/second'''
+        return path.bandwidth
+
+    def update(self, path, tnow):
+        '''called before sending, to adjust the rate'''
+        pass
+
+    def on_ack(self, path, rtt, acked_bytes, tnow):
+        '''called for each received ack with its round trip time and the
+        number of newly acknowledged payload bytes'''
+        pass
+
+    def on_loss(self, path, tnow):
+        '''called when a chunk is resent because its ack timed out'''
+        pass
+
+
+class DelayRateControl(FixedRateControl):
+    '''a delay based rate controller
+
+    The lowest round trip time seen recently is taken as the delay of the
+    empty link. Once per update interval the rate is cut if the smoothed
+    round trip time has risen more than target_delay above that, otherwise
+    it is raised. Random loss on a radio link does not cause backoff, unless
+    loss_threshold is set and the fraction of chunks timing out in an
+    interval exceeds it. The rate stays between min_rate and the path's
+    bandwidth, and is also held near the rate acks are arriving at
+
+    target_delay:   allowed queueing delay in seconds (default 0.05)
+    min_rate:       lowest send rate in bytes/second (default 5000)
+    increase:       fraction of the path bandwidth added per interval (default 0.05)
+    decrease:       factor applied to the rate on congestion (default 0.85)
+    interval:       minimum update interval in seconds, the smoothed RTT is
+                    used if larger (default 0.1)
+    base_window:    seconds over which the minimum RTT is remembered (default 10)
+    loss_threshold: fraction of timed out chunks per interval that counts as
+                    congestion, None to ignore loss (default None)
+    '''
+    def __init__(self, target_delay=0.05, min_rate=5000, increase=0.05, decrease=0.85,
+                 interval=0.1, base_window=10.0, loss_threshold=None):
+        self.target_delay = target_delay
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.base_window = base_window
+        self.loss_threshold = loss_threshold
+        self.current_rate = None
+        self.srtt = None
+        # minimum RTT in the current and previous base_window
+        self.base_rtt = [None, None]
+        self.base_start = None
+        self.last_update = None
+        self.acked_bytes = 0
+        self.acked_chunks = 0
+        self.lost_chunks = 0
+
+    def rate(self, path, tnow):
+        '''return the current send rate in bytes/second'''
+        if self.current_rate is None:
+            return float(path.bandwidth)
+        return self.current_rate
+
+    def update(self, path, tnow):
+        '''adjust the rate once per interval'''
+        if self.current_rate is None:
+            self.current_rate = float(path.bandwidth)
+            self.last_update = tnow
+            self.base_start = tnow
+        self._update(path, tnow)
+
+    def on_ack(self, path, rtt, acked_bytes, tnow):
+        '''track the RTT and delivery rate'''
+        if rtt <= 0:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        for i in range(2):
+            if self.base_rtt[i] is None or rtt < self.base_rtt[i]:
+                self.base_rtt[i] = rtt
+        self.acked_bytes += acked_bytes
+        if acked_bytes > 0:
+            self.acked_chunks += 1
+
+    def on_loss(self, path, tnow):
+        '''count a timed out chunk'''
+        self.lost_chunks += 1
+
+    def _update(self, path, tnow):
+        deltat = tnow - self.last_update
+        if self.srtt is None or deltat < max(self.interval, self.srtt):
+            return
+        if tnow - self.base_start > self.base_window:
+            # forget RTTs older than two windows, so a route change is noticed
+            self.base_rtt = [self.base_rtt[1], None]
+            self.base_start = tnow
+        base_rtt = min([r for r in self.base_rtt if r is not None] or [self.srtt])
+        congested = self.srtt - base_rtt > self.target_delay
+        if self.loss_threshold is not None:
+            sent = self.acked_chunks + self.lost_chunks
+            if sent > 0 and self.lost_chunks / float(sent) > self.loss_threshold:
+                congested = True
+        if congested:
+            self.current_rate *= self.decrease
+        else:
+            self.current_rate += self.increase * path.bandwidth
+            # don't run far ahead of what the link is delivering
+            delivered = self.acked_bytes / deltat
+            if delivered > 0:
+                self.current_rate = min(self.current_rate, 2 * delivered + self.increase * path.bandwidth)
+        self.current_rate = max(self.min_rate, min(self.current_rate, path.bandwidth))
+        self.last_update = tnow
+        self.acked_bytes = 0
+        self.acked_chunks = 0
+        self.lost_chunks = 0
+
+
+class BlockSenderPath:
+    '''one network path of a BlockSender, a socket and destination with
+    its own send rate, token bucket and round trip time and loss estimates
+
+    dest is a (host,port) tuple, or None to use the sender's default
+    destination. tnow is the current time (default time.time())'''
+    def __init__(self, sock, dest, bandwidth, rate_control, rtt, tnow=None):
+        self.sock = sock
+        self.dest = dest
+        self.bandwidth = bandwidth
+        self.rate_control = rate_control
+        # scatter-gather sends avoid joining packet headers onto the payload
+        self.use_sendmsg = hasattr(sock, 'sendmsg')
+        self.use_recv_into = hasattr(sock, 'recvfrom_into')
+        self.tokens = 0
+        if tnow is None:
+            tnow = time.time()
+        self.last_token_time = tnow
+        self.rtt_estimate = rtt
+        self.rtt_sampled = False
+        # moving average of the fraction of chunks sent on this path that were lost
+        self.loss = 0.0
+        self.send_count = 0
+        self.recv_count = 0
+
+    def __str__(self):
+        return 'BlockSenderPath<%s,%u,%.2f,%.2f>' % (str(self.dest), self.bandwidth, self.rtt_estimate, self.loss)
+
+    def rate(self, tnow, multipath):
+        '''return the send rate of this path. When there are several paths,
+        a path that is losing nearly everything is cut to a trickle which
+        is enough to notice when it comes back'''
+        rate = self.rate_control.rate(self, tnow)
+        if multipath and self.loss > 0.9:
+            rate *= 0.05
+        return rate
+
+    def chunk_lost(self, tnow):
+        '''record a chunk sent on this path whose ack timed out'''
+        self.loss = 0.98 * self.loss + 0.02
+        self.rate_control.on_loss(self, tnow)
+
+    def chunk_delivered(self):
+        '''record a chunk sent on this path that was acked'''
+        self.loss = 0.98 * self.loss
+
+    def sendto(self, parts, dest):
+        '''send a packet made up of a list of buffers'''
+        if self.use_sendmsg:
+            self.sock.sendmsg(parts, [], 0, dest)
+            return
+        buf = bytearray(parts[0])
+        for p in parts[1:]:
+            buf += p
+        self.sock.sendto(buf, dest)
+
+
 class BlockSender:
     '''a reliable datagram block sender
 
@@ -242,8 +1697,15 @@ class BlockSender:
     dest_port:     default port for send, defaults to port
     listen_ip:     IP to listen on (default is wildcard)
     bandwidth:     bandwidth to use in bytes/second (default 100000 bytes/s)
-    completed_len: how many completed blocks to remember (default 100)
+    completed_len: how many completed block IDs to remember for spotting
+               duplicate chunks (default 1000)
     chunk_size:    size of data chunks to send in bytes (default 1000)
+    auto_chunk:    tune the chunk size of new blocks to each destination, starting from
+               chunk_size. Chunks are kept within the path MTU and sized for the best
+               delivered payload per byte sent at the observed loss rate. The path MTU
+               is only probed when the sender made its own socket rather than being
+               given sock. A chunk_size given to send() overrides it, see
+               get_chunk_size() (default False)
     backlog:       maximum number of packets to send per tick (default 100)
     rtt:           initial round trip time estimate (0.01 seconds)
     sock:          a optional socket object to use, needs sendto() and recvfrom()
@@ -251,53 +1713,229 @@ class BlockSender:
     mss:           maximum segment size for any packet. This limits all
                packet types (default is zero, meaning no limit)
     ordered:       set to True to force blocks to be delivered in the sending order (default False)
+    burst:         size of the send token bucket in bytes. Defaults to backlog full
+               chunks, or to two chunks once start() has been called
+    rate_control:  a rate controller choosing the send rate up to bandwidth, e.g.
+               DelayRateControl() (default FixedRateControl(), sending at bandwidth)
+    fec:           send an XOR parity packet after every fec chunks of a block, letting
+               the receiver rebuild one lost chunk per group without waiting for a
+               retransmit. Zero disables (default 0, maximum 255)
+    recv_batch:    number of receive buffers to drain the socket into before
+               processing packets (default 64)
+    rcvbuf:        optional socket receive buffer size in bytes
+    gro:           enable UDP generic receive offload on linux (default False)
+    send_mode:     how packets from one tick are sent. 'single' sends each with its
+               own system call, 'gso' batches them with sendmmsg() and uses UDP
+               segmentation offload for runs of equal sized chunks. 'gso' is linux
+               only and falls back to 'single' (default 'single')
+    zero_copy:     send data passed to send() without copying it. The caller must
+               not modify the data until the send completes (default False)
+    compression:   compress blocks before sending with 'zlib', 'bz2' or 'lzma' (python3
+               only). Blocks that a sample shows won't compress well, such as JPEG
+               images, are sent as is. The receiver decompresses transparently
+               (default None, no compression)
+    compression_level: codec compression level (default None, the codec's default)
+    ack_format:    how acks for partly received blocks are encoded. 'extents' sends a
+               list of received runs, 'bitmap' a window of the received chunk bitmap
+               and 'auto' whichever is smaller. 'bitmap' and 'auto' need a peer
+               that understands PKT_SACK (default 'extents')
+    ack_delay:     longest time in seconds to hold back an ack for an incoming block, so
+               that one ack covers several chunks. Acks are sent at once when a new
+               gap in a block shows a lost chunk, and when a block completes. The
+               time an ack was held is added to its echoed timestamp so the
+               sender's RTT estimate is unaffected (default 0, ack every tick)
+    ack_every:     send an ack once this many chunks of a block have arrived since the
+               last one, even if ack_delay has not passed (default 0, no limit)
+    peer_ack_delay: the ack_delay used by the other end, added to the retransmit
+               timeout as the RTT estimate leaves it out (default ack_delay)
+    multi_ack:     pack the acks for several blocks into one PKT_MULTI datagram. Needs
+               a peer that understands PKT_MULTI (default False)
+    spool_dir:     optional directory to receive large incoming blocks into. Each such
+               block is written to a memory mapped <block_id>.part file, which is
+               renamed to <block_id>.blk when the block is delivered. available()
+               then returns the mmap object and the caller owns the file, see
+               spool_path()
+    spool_threshold: incoming blocks of at least this many bytes are spooled
+               (default 1000000)
+    journal_dir:   optional directory to keep a journal of outgoing and incoming
+               blocks in, so that transfers resume where they left off after a
+               restart. Outgoing payloads are written to the journal by send(),
+               and all incoming blocks are received into spool files (in
+               journal_dir/in unless spool_dir is set). Blocks that spool_dir and
+               spool_threshold would not have spooled are still delivered in memory,
+               their spool file is removed. Resumed blocks go on the default channel
+               and their callbacks are lost
+    journal_interval: how often in seconds to save ack bitmaps to the journal (default 1)
+    aging:         seconds of queueing that count as one priority level. If set, a low
+               priority block is sent once it has waited long enough, rather than
+               only when no higher priority block is queued (default None, strict
+               priority)
+    stats_file:    optional file name or file object to append a JSON line of get_stats()
+               to every stats_interval seconds
+    stats_interval: seconds between lines written to stats_file (default 1)
+    progress_callback: optional function called as progress_callback(block_id, view)
+               whenever more of the start of an incoming block has arrived. view
+               is a read-only memoryview of the received prefix. The callback
+               runs in the I/O thread if start() has been called. See also partial()
+    clock:         function returning the current time in seconds. A virtual clock
+               lets a simulation run faster than real time, see
+               block_sender_emu.Simulation (default time.time)
+    seed:          seed for the random numbers used for block ids and set_packet_loss(),
+               for repeatable runs (default None)
     debug:         enable debugging (default False)
     '''
     def __init__(self, port=0, dest_ip=None, dest_port=None, listen_ip='', bandwidth=100000,
-             completed_len=1000, chunk_size=1000, backlog=100, rtt=0.01,
-             sock=None, mss=0, ordered=False,
-             debug=False, filler = None): ##TO DO... populate section with a filler char on creation
+             completed_len=1000, chunk_size=1000, auto_chunk=False, backlog=100, rtt=0.01,
+             sock=None, mss=0, ordered=False, zero_copy=False, fec=0, rate_control=None, burst=None,
+             recv_batch=64, rcvbuf=None, gro=False, send_mode='single',
+             compression=None, compression_level=None, ack_format='extents', ack_delay=0,
+             ack_every=0, peer_ack_delay=None, multi_ack=False, spool_dir=None,
+             spool_threshold=1000000, journal_dir=None, journal_interval=1.0,
+             aging=None, stats_file=None, stats_interval=1.0, progress_callback=None,
+             clock=time.time, seed=None, debug=False, filler = None): ##TO DO... populate section with a filler char on creation
+        self.enable_debug = debug
+        self.clock = clock
+        self.random = random.Random(seed)
         self.bandwidth = bandwidth
         self.port = port
         if dest_port is None:
             dest_port = port
+        # a socket we made goes over the host's UDP stack, one passed in may not
+        self.own_sock = sock is None
         if sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-	    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.bind((listen_ip, port))
             self.sock.setblocking(False)
+            if rcvbuf:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
             if port == 0:
                 (host, self.port) = self.sock.getsockname()
         else:
             self.sock = sock
+        # packets are received into a preallocated pool of buffers
+        self.recv_buffers = [bytearray(MAX_PACKET_SIZE) for i in range(max(recv_batch, 1))]
+        self.recv_views = [memoryview(b) for b in self.recv_buffers]
+        self.batch_sender = None
+        self.tx_pending = None
+        # (index, blk, chunk_id, entry, sent, size, group) for each chunk in
+        # tx_pending, for _unsend_chunks()
+        self.tx_chunks = None
+        if send_mode not in ('single', 'gso'):
+            raise BlockSenderException('unknown send_mode %s' % send_mode)
+        if send_mode == 'gso':
+            try:
+                self.batch_sender = BlockSenderBatch(self.sock)
+            except BlockSenderException as e:
+                self._debug('batched send disabled: %s' % str(e))
+        self.use_gro = False
+        if gro and hasattr(self.sock, 'recvmsg_into'):
+            try:
+                self.sock.setsockopt(_SOL_UDP, _UDP_GRO, 1)
+                self.use_gro = True
+                self.gro_cmsg_size = socket.CMSG_SPACE(struct.calcsize('i'))
+            except socket.error:
+                pass
         self.dest_ip = dest_ip
         self.dest_port = dest_port
-        self.outgoing = []
+        # outgoing blocks, queued per channel, see add_channel()
+        self.outgoing = BlockSenderChannels(aging, clock)
         self.incoming = []
+        # block_id -> block indexes into outgoing and incoming
+        self.outgoing_ids = {}
+        self.incoming_ids = {}
+        # incoming blocks that have completed but not yet been returned by available()
+        self.incoming_ready = collections.deque()
+        # block_id -> incoming block whose received prefix has grown since partial()
+        self.incoming_progress = collections.OrderedDict()
+        self.progress_callback = progress_callback
+        self.spool_dir = spool_dir
+        self.spool_threshold = spool_threshold
+        self.journal = None
+        self.journal_interval = journal_interval
+        self.journal_time = clock()
+        # blocks whose bitmaps have changed since they were last saved
+        self.journal_dirty = set()
+        if journal_dir is not None:
+            self.journal = BlockSenderJournal(journal_dir)
         self.block_status = []
-        self.next_block_id = os.getpid() << 20
-        self.last_send_time = time.time()
-        self.last_recv_time = time.time()
-        self.acks_needed = set()
+        if seed is None:
+            self.next_block_id = os.getpid() << 20
+        else:
+            self.next_block_id = self.random.getrandbits(16) << 20
+        self.last_send_time = clock()
+        self.last_recv_time = self.last_send_time
+        # incoming blocks and (block_id, dest, path) tuples of completed blocks
+        # that need an ack. A tuple maps to the timestamp and arrival time of
+        # the chunk that prompted the ack. An ordered dict rather than a set
+        # so that acks go out in the same order on every run
+        self.acks_needed = collections.OrderedDict()
         self.packet_loss = 0
         self.completed_len = completed_len
-        self.completed = []
-        self.completed2 = []
+        self.completed = BlockSenderHistory(completed_len)
+        # outgoing blocks we gave up on, so that a late ack is answered with
+        # another cancel
+        self.cancelled = BlockSenderHistory(completed_len)
+        # heap of (deadline, seq, block) for outgoing blocks with a deadline
+        self.deadlines = []
+        self.deadline_seq = 0
         if chunk_size > 65535:
             raise BlockSenderException('chunk size must be less than 65536')
         self.chunk_size = chunk_size
-        self.enable_debug = debug
+        self.auto_chunk = auto_chunk
+        # dest -> BlockSenderChunkTuner, see auto_chunk
+        self.chunk_tuners = {}
         self.backlog = backlog
         self.rtt_estimate = rtt
+        # set once an ack has given a round trip time sample
+        self.rtt_sampled = False
         self.rtt_max = 5
         self.rtt_multiplier = 3.0
         self.mss = mss
         self.ordered = ordered
-        self.bonus_bytes = 0
+        self.zero_copy = zero_copy
+        if fec < 0 or fec > 255:
+            raise BlockSenderException('fec group size must be between 0 and 255')
+        self.fec = fec
+        self._codec_id(compression)
+        self.compression = compression
+        self.compression_level = compression_level
+        if ack_format not in ('extents', 'bitmap', 'auto'):
+            raise BlockSenderException('unknown ack_format %s' % ack_format)
+        self.ack_format = ack_format
+        self.ack_delay = ack_delay
+        self.ack_every = ack_every
+        if peer_ack_delay is None:
+            peer_ack_delay = ack_delay
+        self.peer_ack_delay = peer_ack_delay
+        self.multi_ack = multi_ack
+        if rate_control is None:
+            rate_control = FixedRateControl()
+        self.rate_control = rate_control
+        # the primary path uses our socket and default destination, see add_path()
+        self.paths = [BlockSenderPath(self.sock, None, bandwidth, rate_control, rtt, self.clock())]
+        # size of the token buckets pacing sends on each path
+        self.burst = burst
+        # background I/O thread, see start()
+        self.lock = threading.RLock()
+        self.thread = None
+        self.running = False
+        self.delivery = None
+        # blocks the thread completed but nobody collected before stop()
+        self.undelivered = collections.deque()
+        # the burst the caller gave, start() picks one if it is None
+        self.caller_burst = burst
+        self.wakeup = None
         self.efficiency = 1.0
         self.bandwidth_used = 0.0
         self.send_count = 0
         self.recv_count = 0
+        self.stats = BlockSenderStats()
+        if stats_file is not None and not hasattr(stats_file, 'write'):
+            stats_file = open(stats_file, 'a')
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.stats_time = 0
 
         # work out the overheads of the packet types
         self.chunk_overhead = BlockSenderChunk(0,0,0,'',0,0,0).header_size
@@ -305,6 +1943,13 @@ class BlockSender:
         if self.mss and (self.mss < self.chunk_overhead + 1 or
                  self.mss < self.ack_overhead + 4):
             raise BlockSenderException('mss is too small')
+        if self.mss and ack_format != 'extents' and \
+           self.mss < BlockSenderSet(0,0,0).sack_header_size + PACKET_HEADER_SIZE + 1:
+            # a bitmap ack needs room for at least one byte of bitmap
+            raise BlockSenderException('mss is too small for bitmap acks')
+
+        if self.journal is not None:
+            self._resume_journal()
 
     def get_port(self):
         '''return the port we are receiving on'''
@@ -323,6 +1968,54 @@ class BlockSender:
     def set_bandwidth(self, bandwidth):
         '''set the bandwidth on an open sender'''
         self.bandwidth = bandwidth
+        self.paths[0].bandwidth = bandwidth
+
+    def add_path(self, dest, port=0, listen_ip='', sock=None, bandwidth=None, rate_control=None,
+                 rcvbuf=None):
+        '''add another network path, e.g. a second radio. Chunks are spread
+        over all paths according to their bandwidth and loss, and acks are
+        accepted on any of them. Returns the new BlockSenderPath
+
+        dest:         (host,port) tuple to send to on this path
+        port:         UDP port to listen on, zero for a system allocated port
+        listen_ip:    IP to listen on, e.g. the address of the radio interface
+        sock:         optional socket object to use instead of a new UDP socket
+        bandwidth:    bandwidth of this path in bytes/second (default the sender's)
+        rate_control: rate controller for this path (default FixedRateControl())
+        rcvbuf:       optional socket receive buffer size in bytes
+        '''
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((listen_ip, port))
+            sock.setblocking(False)
+            if rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if bandwidth is None:
+            bandwidth = self.bandwidth
+        if rate_control is None:
+            rate_control = FixedRateControl()
+        path = BlockSenderPath(sock, dest, bandwidth, rate_control, self.rtt_estimate, self.clock())
+        with self.lock:
+            self.paths.append(path)
+        return path
+
+    def add_channel(self, name, weight=1, min_rate=0):
+        '''add a logical channel for send() to queue blocks on, e.g. to keep
+        telemetry flowing alongside bulk transfers. When several channels
+        have data due the send budget of each tick is shared between them
+        by deficit round robin in proportion to their weights. Within a
+        channel blocks are sent in priority order. Adding an existing
+        channel changes its weight and minimum rate. Blocks sent without a
+        channel go on the 'default' channel, which has weight 1
+
+        name:     channel name
+        weight:   share of the bandwidth relative to the other busy channels (default 1)
+        min_rate: bytes/second the channel is served first with while it has data
+                  due, whatever its weight (default 0)
+        '''
+        with self.lock:
+            self.outgoing.add(name, weight, min_rate)
 
     def get_efficiency(self):
         '''return the average efficiency of the link. An efficiency of 1.0 means
@@ -334,24 +2027,143 @@ class BlockSender:
         '''return an estimate of the round trip time'''
         return self.rtt_estimate
 
+    def get_send_rate(self):
+        '''return the send rate chosen by the rate controllers, summed over all paths'''
+        tnow = self.clock()
+        return sum([p.rate(tnow, len(self.paths) > 1) for p in self.paths])
+
+    def get_chunk_size(self, dest=None):
+        '''return the chunk size new blocks to dest (default the default destination) are sent with'''
+        if dest is None:
+            dest = (self.dest_ip, self.dest_port)
+        tuner = self.chunk_tuners.get(dest, None)
+        if tuner is None:
+            return self.chunk_size
+        return tuner.chunk_size()
+
+    def _chunk_tuner(self, dest):
+        '''return the chunk size tuner for a destination'''
+        tuner = self.chunk_tuners.get(dest, None)
+        if tuner is None:
+            tuner = BlockSenderChunkTuner(dest, self.chunk_size,
+                                          _UDP_IP_OVERHEAD + PACKET_HEADER_SIZE + self.chunk_overhead + 1,
+                                          probe_mtu=self.own_sock)
+            self.chunk_tuners[dest] = tuner
+        return tuner
+
     def get_bandwidth_used(self):
         '''return a moving average of the actual bandwidth used'''
         return self.bandwidth_used
 
-    def send(self, data, dest=None, chunk_size=None, callback=None, priority=0, block_id = None):
+    def get_stats(self):
+        '''return a dict of transfer statistics: the counters and histograms
+        of BlockSenderStats plus the current estimates and queue depths'''
+        with self.lock:
+            tnow = self.clock()
+            stats = self.stats.snapshot()
+            stats['time'] = tnow
+            stats['rtt_estimate'] = self.rtt_estimate
+            stats['efficiency'] = self.efficiency
+            stats['bandwidth_used'] = self.bandwidth_used
+            stats['send_rate'] = self.get_send_rate()
+            stats['queue'] = { 'outgoing' : len(self.outgoing),
+                               'incoming' : len(self.incoming),
+                               'ready' : len(self.incoming_ready),
+                               'acks_needed' : len(self.acks_needed),
+                               'channels' : dict([(c.name, len(c.queue))
+                                                  for c in self.outgoing.channels.values()]) }
+            stats['paths'] = [ { 'dest' : str(p.dest), 'rtt_estimate' : p.rtt_estimate, 'loss' : p.loss,
+                                 'send_count' : p.send_count, 'recv_count' : p.recv_count }
+                               for p in self.paths ]
+            stats['chunk_sizes'] = dict([(str(t.dest), t.chunk_size()) for t in self.chunk_tuners.values()])
+            return stats
+
+    def _log_stats(self):
+        '''write a line of statistics to stats_file if one is due'''
+        if self.stats_file is None:
+            return
+        tnow = self.clock()
+        if tnow - self.stats_time < self.stats_interval:
+            return
+        self.stats_time = tnow
+        try:
+            self.stats_file.write(json.dumps(self.get_stats()) + '\n')
+            self.stats_file.flush()
+        except (IOError, OSError, ValueError) as e:
+            self._debug('stats: %s' % str(e))
+
+    def send(self, data, dest=None, chunk_size=None, callback=None, priority=0, block_id = None,
+             zero_copy=None, compression=None, channel=None, deadline=None, expired_callback=None):
         '''send a data block
 
+        data:       bytes or any buffer object, e.g. bytearray, memoryview or mmap
         dest:       optional (host,port) tuple
         chunk_size: network send size for this block (defaults to self.chunk_size)
         callback:   optional callback function on completion of send (default None)
         priority:   optional priority for sending this packet. Higher priority packets
                     are sent first (default 0)
         block_id:    optional can be set by external program to add block location info (WARNING must be unique!)
+        zero_copy:  send mutable buffers without copying them (defaults to self.zero_copy)
+        compression: codec to compress this block with, or 'none' (defaults to self.compression)
+        channel:    name of the channel to send on, see add_channel() (default 'default')
+        deadline:   optional time, as given by the sender's clock, after which the block is no
+                    longer worth sending. Among blocks of equal priority the earliest
+                    deadline is sent first. An unfinished block is dropped at its deadline
+                    and the receiver told to discard what it has of it
+        expired_callback: optional function called when the block is dropped at its deadline
+
+        Returns the block_id of the queued block
         '''
+        if compression is None:
+            compression = self.compression
+        codec = self._codec_id(compression)
+        if codec != CODEC_NONE and len(data) > 0 and _worth_compressing(data):
+            # compress outside the lock, it can take a while
+            compressed = _compress(_tobytes(data), codec, self.compression_level)
+            if len(compressed) < len(data):
+                data = compressed
+            else:
+                codec = CODEC_NONE
+        else:
+            codec = CODEC_NONE
+        with self.lock:
+            block_id = self._send(data, dest, chunk_size, callback, priority, block_id, zero_copy, codec,
+                                  channel, deadline, expired_callback)
+        self._wake()
+        return block_id
+
+    def _codec_id(self, compression):
+        '''return the codec id for a compression name'''
+        if compression is None or compression == 'none':
+            return CODEC_NONE
+        codec = _CODEC_IDS.get(compression, None)
+        if codec is None or (codec == CODEC_LZMA and lzma is None):
+            raise BlockSenderException('unsupported compression %s' % compression)
+        return codec
+
+    def _send(self, data, dest, chunk_size, callback, priority, block_id, zero_copy, codec=CODEC_NONE,
+              channel=None, deadline=None, expired_callback=None):
+        '''queue a data block, see send()'''
+        if channel is not None:
+            channel = self.outgoing.get(channel)
+        if zero_copy is None:
+            zero_copy = self.zero_copy
+        if dest is None:
+            if self.dest_ip is None:
+                raise BlockSenderException('no destination specified in send')
+            dest = (self.dest_ip, self.dest_port)
+        tuner = None
+        if not chunk_size and self.auto_chunk:
+            tuner = self._chunk_tuner(dest)
+            # a large block may need bigger chunks to stay within 65535 of them
+            chunk_size = max(tuner.chunk_size(), (len(data) + 65534) // 65535)
         if not chunk_size:
             chunk_size = self.chunk_size
         if self.mss and chunk_size > self.chunk_overhead + self.mss:
             chunk_size = self.mss - (self.chunk_overhead + PACKET_HEADER_SIZE)
+        if self.mss and codec != CODEC_NONE:
+            # room for the codec id
+            chunk_size = min(chunk_size, self.mss - (self.chunk_overhead + 1 + PACKET_HEADER_SIZE))
 
         num_chunks = (len(data) + (chunk_size-1)) // chunk_size
         if num_chunks > 65535:
@@ -360,34 +2172,368 @@ class BlockSender:
             block_id = self.next_block_id #use the default block id
         
         self.next_block_id += 1
-        if dest is None:
-            if self.dest_ip is None:
-                raise BlockSenderException('no destination specified in send')
-            dest = (self.dest_ip, self.dest_port)
         
         
         ###FIXME define where the block is going? dest = self.dest?
         newblk = BlockSenderBlock(block_id, len(data), chunk_size, dest, self.mss,
-                      data=data, callback=callback, priority=priority)
-
-        # if this block has a non-zero priority, insert after the last one with a
-        # higher or equal priority
-        if priority > 0:
-            for i in range(len(self.outgoing), 0, -1):
-                if self.outgoing[i-1].priority >= priority:
-                                        #print("Inserted blk %u len=%u %s" % (i, len(self.outgoing), newblk))
-                    self.outgoing.insert(i, newblk)
-                    return
-                        #print("Inserted blk %u len=%u %s" % (0, len(self.outgoing), newblk))
-            self.outgoing.insert(0, newblk)
+                      data=data, callback=callback, priority=priority, zero_copy=zero_copy,
+                      fec=self.fec, codec=codec)
+        newblk.tuner = tuner
+        newblk.channel = channel
+        newblk.deadline = deadline
+        newblk.expired_callback = expired_callback
+        newblk.create_time = self.clock()
+        self.stats.blocks_queued += 1
+        if self.journal is not None:
+            self.journal.add_outgoing(newblk)
+        self.outgoing_ids[block_id] = newblk
+        self._add_deadline(newblk)
+
+        # higher priority blocks are sent first, equal priorities in the order queued
+                #print("Queued blk len=%u %s" % (len(self.outgoing), newblk))
+        self.outgoing.push(newblk)
+        return block_id
+
+    def cancel(self, block_id):
+        '''stop sending an outgoing block and tell the receiver to discard it.
+        Return True if the block was queued'''
+        with self.lock:
+            blk = self.outgoing_ids.get(block_id, None)
+            if blk is None:
+                return False
+            self._cancel_outgoing(blk)
+            return True
+
+    def set_deadline(self, block_id, deadline):
+        '''change the deadline of an outgoing block, None for no deadline. The
+        block keeps its place in the queue. Return True if the block was queued'''
+        with self.lock:
+            blk = self.outgoing_ids.get(block_id, None)
+            if blk is None:
+                return False
+            blk.deadline = deadline
+            self._add_deadline(blk)
+            if self.journal is not None:
+                self.journal.save_outgoing_header(blk)
+            return True
+
+    def _cancel_outgoing(self, blk):
+        '''give up on an outgoing block'''
+        self._remove_outgoing(blk)
+        self.cancelled.add(blk.block_id)
+        self.stats.blocks_cancelled += 1
+        self._send_cancel(blk.block_id, blk.dest)
+
+    def _send_cancel(self, block_id, dest, path=None):
+        '''tell the receiver of a block to discard it'''
+        try:
+            self._send_object(BlockSenderCancel(block_id), PKT_CANCEL, dest, path)
+        except Exception as e:
+            self._debug('_send_cancel: ' + str(e))
+
+    def _add_deadline(self, blk):
+        '''track the deadline of an outgoing block'''
+        if blk.deadline is None:
             return
-        # otherwise append to the outgoing list
-                #print("Appended blk len=%u %s" % (len(self.outgoing), newblk))
-        self.outgoing.append(newblk)
+        heapq.heappush(self.deadlines, (blk.deadline, self.deadline_seq, blk))
+        self.deadline_seq += 1
 
-    def _crc(self, buffer):
+    def _expire_blocks(self):
+        '''drop the outgoing blocks that have passed their deadline'''
+        if not self.deadlines:
+            return
+        tnow = self.clock()
+        while self.deadlines and self.deadlines[0][0] <= tnow:
+            (deadline, seq, blk) = heapq.heappop(self.deadlines)
+            if self.outgoing_ids.get(blk.block_id, None) is not blk:
+                # completed or cancelled already
+                continue
+            if deadline != blk.deadline:
+                # changed by set_deadline()
+                continue
+            if self.enable_debug:
+                self._debug('block %u expired with %u/%u chunks acked' % (
+                    blk.block_id, blk.acks.count, blk.num_chunks))
+            self._cancel_outgoing(blk)
+            self.stats.blocks_expired += 1
+            if blk.expired_callback:
+                blk.expired_callback()
+        if len(self.deadlines) > 2 * len(self.outgoing_ids) + 16:
+            # drop the entries of blocks that completed before their deadline,
+            # and deadlines that have been changed
+            self.deadlines = [e for e in self.deadlines
+                              if self.outgoing_ids.get(e[2].block_id, None) is e[2] and e[0] == e[2].deadline]
+            heapq.heapify(self.deadlines)
+
+    def _remove_outgoing(self, blk):
+        '''remove a block from the outgoing queue'''
+        del self.outgoing_ids[blk.block_id]
+        self.outgoing.remove(blk)
+        if self.journal is not None:
+            self.journal_dirty.discard(blk)
+            self.journal.remove_outgoing(blk.block_id)
+
+    def _resume_journal(self):
+        '''reload the outgoing and incoming blocks saved in the journal'''
+        for (header, data, bits) in self.journal.load_outgoing():
+            blk = BlockSenderBlock(header['block_id'], header['size'], header['chunk_size'],
+                                   tuple(header['dest']), self.mss, data=data,
+                                   priority=header['priority'], zero_copy=True,
+                                   fec=header['fec'], codec=header['codec'])
+            if bits is not None:
+                try:
+                    blk.acks.set_bits(bits)
+                except BlockSenderException:
+                    pass
+            # the receiver may have lost chunks we think it has, see _process_packet()
+            blk.resumed = True
+            blk.deadline = header.get('deadline', None)
+            blk.create_time = self.clock()
+            if self.enable_debug:
+                self._debug('resumed outgoing block %u with %u/%u chunks acked' % (
+                    blk.block_id, blk.acks.count, blk.num_chunks))
+            self.outgoing_ids[blk.block_id] = blk
+            self._add_deadline(blk)
+            self.outgoing.push(blk)
+        for (header, bits) in self.journal.load_incoming():
+            block_id = header['block_id']
+            spool_path = self.spool_path(block_id, partial=True)
+            if (bits is None or not os.path.exists(spool_path) or
+                os.path.getsize(spool_path) != header['size']):
+                # the bitmap would claim chunks the spool file doesn't hold
+                self.journal.remove_incoming(block_id)
+                continue
+            blk = BlockSenderBlock(block_id, header['size'], header['chunk_size'],
+                                   tuple(header['dest']), self.mss, codec=header['codec'],
+                                   spool_path=spool_path)
+            try:
+                blk.acks.set_bits(bits)
+            except BlockSenderException:
+                self.journal.remove_incoming(block_id)
+                continue
+            blk.contiguous = blk.acks.first_missing
+            blk.data_length = min(blk.acks.count * blk.chunk_size, blk.size)
+            if self.enable_debug:
+                self._debug('resumed incoming block %u with %u/%u chunks' % (
+                    block_id, blk.acks.count, blk.num_chunks))
+            self.incoming.append(blk)
+            self.incoming_ids[block_id] = blk
+            if blk.complete():
+                self.incoming_ready.append(blk)
+
+    def _flush_journal(self, force=False):
+        '''save the bitmaps of blocks that have changed, every journal_interval seconds'''
+        if self.journal is None or not self.journal_dirty:
+            return
+        tnow = self.clock()
+        if not force and tnow - self.journal_time < self.journal_interval:
+            return
+        self.journal_time = tnow
+        for blk in self.journal_dirty:
+            try:
+                if self.outgoing_ids.get(blk.block_id, None) is blk:
+                    self.journal.save_outgoing(blk)
+                elif self.incoming_ids.get(blk.block_id, None) is blk:
+                    self.journal.save_incoming(blk)
+            except (IOError, OSError) as e:
+                self._debug('journal: %s' % str(e))
+        self.journal_dirty.clear()
+
+    def start(self):
+        '''start a background thread that owns the socket
+
+        The thread receives packets, sends acks and paces outgoing chunks
+        from a token bucket, sleeping in select() between packets. Completed
+        incoming blocks are passed to available() and recv() through a
+        thread safe queue. Other threads may call send() and cancel() while
+        it runs, but should not call tick()
+        '''
+        if self.thread is not None:
+            return
+        self.caller_burst = self.burst
+        if self.burst is None:
+            self.burst = 2 * (self.chunk_size + self.chunk_overhead + PACKET_HEADER_SIZE)
+        self.delivery = queue.Queue()
+        if hasattr(self.sock, 'fileno') and fcntl is not None:
+            wakeup = os.pipe()
+            # a full pipe wakes the thread as well as one more byte would
+            flags = fcntl.fcntl(wakeup[1], fcntl.F_GETFL)
+            fcntl.fcntl(wakeup[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.wakeup = wakeup
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''stop the background thread. Blocks it completed that have not
+        been collected are still returned by available() and recv()'''
+        if self.thread is None:
+            return
+        self.running = False
+        self._wake()
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            # _wake() reads it under the lock, so no write can hit a closed fd
+            wakeup = self.wakeup
+            self.wakeup = None
+        if wakeup is not None:
+            for fd in wakeup:
+                os.close(fd)
+        while True:
+            try:
+                self.undelivered.append(self.delivery.get_nowait())
+            except queue.Empty:
+                break
+        self.delivery = None
+        self.burst = self.caller_burst
+        self.save_journal()
+
+    def save_journal(self):
+        '''save any unsaved ack bitmaps to the journal now, e.g. before exiting'''
+        with self.lock:
+            self._flush_journal(force=True)
+
+    def _wake(self):
+        '''wake the background thread, e.g. because there is new data to send'''
+        with self.lock:
+            if self.wakeup is None:
+                return
+            try:
+                os.write(self.wakeup[1], b'x')
+            except OSError as e:
+                # EAGAIN: the pipe is full, so the thread will wake anyway.
+                # EBADF: stop() closed it
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                    raise
+
+    def _run(self):
+        '''background thread main loop'''
+        while self.running:
+            with self.lock:
+                self.tick()
+                while True:
+                    blk = self._pop_completed(self.ordered)
+                    if blk is None:
+                        break
+                    self.delivery.put((blk.block_id, blk.data))
+                delay = self._next_send_delay()
+            if self.wakeup is None:
+                time.sleep(max(delay, 0.001))
+                continue
+            try:
+                (rin, win, xin) = select.select([p.sock.fileno() for p in self.paths] + [self.wakeup[0]],
+                                                [], [], delay)
+            except select.error:
+                continue
+            if self.wakeup[0] in rin:
+                os.read(self.wakeup[0], 4096)
+
+    def _bucket_size(self):
+        '''return the size of the send token bucket in bytes'''
+        if self.burst is not None:
+            return self.burst
+        return self.backlog * (self.chunk_size + self.chunk_overhead + PACKET_HEADER_SIZE)
+
+    def next_event_time(self):
+        '''return the time by which tick() should next be called to send the
+        chunks, acks and cancels that fall due, by the sender's clock. Packets
+        that arrive before then also need a tick(). A simulation advances
+        its clock to the earliest of these, see block_sender_emu.Simulation'''
+        with self.lock:
+            return self.clock() + self._next_send_delay()
+
+    def _next_send_delay(self):
+        '''return how long the sender can sleep before a chunk is due to be
+        sent and the token bucket holds enough to send it. Never more than
+        0.1 seconds'''
+        tnow = self.clock()
+        rto = self._rto()
+        due = None
+        prev = None
+        for blk in self.outgoing.walk():
+            if self.ordered and prev is not None and not prev.acks.started():
+                break
+            prev = blk
+            if blk.parity_pending or blk.next_chunk < blk.num_chunks:
+                due = tnow
+                break
+            if blk.retransmit and (due is None or blk.retransmit[0][0] + rto < due):
+                due = blk.retransmit[0][0] + rto
+        delay = 0.1
+        if due is not None:
+            need = self.chunk_size + self.chunk_overhead
+            token_wait = min([(need - p.tokens) / max(p.rate(tnow, len(self.paths) > 1), 1.0)
+                              for p in self.paths])
+            delay = min(delay, max(due - tnow, token_wait, 0))
+        for obj in self.acks_needed:
+            if not isinstance(obj, BlockSenderBlock):
+                return 0
+            delay = min(delay, max(obj.ack_due - tnow, 0))
+        if self.deadlines:
+            delay = min(delay, max(self.deadlines[0][0] - tnow, 0))
+        return delay
+
+    def _rto(self):
+        '''return the time to wait for an ack before resending a chunk. On a
+        slow link this is at least the time to send one chunk at the paced rate'''
+        rto = self.rtt_multiplier*self.rtt_estimate + self.peer_ack_delay
+        packet_time = (self.chunk_size + self.chunk_overhead + PACKET_HEADER_SIZE) / max(self.get_send_rate(), 1.0)
+        return max(rto, packet_time)
+
+    def _crc(self, buffer, crc=0):
         '''produce a 32 bit unsigned crc for a buffer'''
-        return binascii.crc32(bytes(buffer)) & 0xFFFFFFFF
+        return binascii.crc32(buffer, crc) & 0xFFFFFFFF
+
+    def _queue_packet(self, parts, dest, path):
+        '''send a packet, or hold it for a batched send if one is in progress.
+        Only the primary path batches sends'''
+        if self.tx_pending is not None and path is self.paths[0]:
+            self.tx_pending.append((parts, dest))
+        else:
+            path.sendto(parts, dest)
+
+    def _flush_sends(self):
+        '''send any packets held for a batched send'''
+        packets = self.tx_pending
+        chunks = self.tx_chunks
+        self.tx_pending = None
+        self.tx_chunks = None
+        if not packets:
+            return
+        if self.batch_sender is not None:
+            try:
+                sent = self.batch_sender.send(packets)
+                if sent < len(packets):
+                    # the socket buffer filled
+                    self.stats.send_errors += len(packets) - sent
+                    self._unsend_chunks(chunks, sent)
+                return
+            except BlockSenderException as e:
+                self._debug('batched send failed, disabling: %s' % str(e))
+                self.batch_sender = None
+        for (parts, dest) in packets:
+            try:
+                self.paths[0].sendto(parts, dest)
+            except socket.error:
+                self.stats.send_errors += 1
+
+    def _unsend_chunks(self, chunks, first):
+        '''undo the sends of the chunks queued for a batched send from packet
+        index first on, which did not go out. They are due again at once'''
+        for (index, blk, c, entry, sent, size, group) in reversed(chunks):
+            if index < first:
+                break
+            blk.retransmit.remove(sent)
+            if group is not None and group in blk.parity_pending:
+                blk.parity_pending.remove(group)
+            self._unget_chunk(blk, c, entry)
+            sent[2].tokens += size
+            blk.sends -= 1
+            self.stats.chunks_sent -= 1
+            if entry is not None:
+                self.stats.retransmits -= 1
 
     def _debug(self, s):
         '''internal debug function'''
@@ -395,90 +2541,343 @@ class BlockSender:
             print(s)
         pass
 
-    def _send_object(self, obj, type, dest):
-        '''low level object send'''
+    def _send_object(self, obj, type, dest, path=None):
+        '''low level object send, on the primary path unless one is given. obj
+        may also be the already linearized packet'''
+        if path is None:
+            path = self.paths[0]
         if self.packet_loss != 0:
-            if random.uniform(0, 1) < self.packet_loss*0.01:
+            if self.random.uniform(0, 1) < self.packet_loss*0.01:
                                 #print("lose packet")
                 return
         try:
-            buf = obj.pack()
-            crc = self._crc(buf)
-            buf = bytes(struct.pack('<BL', type, crc)) + buf
-            #self.sock.sendto(buf, dest)
-            self.sock.sendto(buf, (self.dest_ip,self.dest_port))
+            if isinstance(obj, bytes):
+                parts = [obj]
+            elif hasattr(obj, 'pack_parts'):
+                parts = obj.pack_parts()
+            else:
+                parts = [obj.pack()]
+            crc = 0
+            size = PACKET_HEADER_SIZE
+            for p in parts:
+                crc = self._crc(p, crc)
+                size += len(p)
+            parts.insert(0, struct.pack('<BL', type, crc))
+            #self._queue_packet(parts, dest, path)
+            self._queue_packet(parts, path.dest or (self.dest_ip,self.dest_port), path)
             ###FIXME HACK this dest is not the correct one... force the use of the specified dest_ip and dest_port
             #print 'sending to', dest
             self.send_count += 1
+            path.send_count += 1
+            self.stats.packets_sent[type] += 1
+            self.stats.bytes_sent[type] += size
                         #print("send_count=%u %s" % (self.send_count, obj))
         except socket.error:
-            pass
+            self.stats.send_errors += 1
 
     def _send_acks(self):
         '''send extents objects to acknowledge data'''
-        tnow = time.time()
+        tnow = self.clock()
         deltat = tnow - self.last_recv_time
         self.last_recv_time = tnow
         if self.acks_needed and self.enable_debug:
             print("sending %u acks deltat=%.2f" % (len(self.acks_needed), deltat))
-        acks_needed = self.acks_needed.copy()
+        acks_needed = list(self.acks_needed)
+        # path -> acks to be sent together in PKT_MULTI packets
+        multi = collections.OrderedDict()
         for obj in acks_needed:
             try:
                 if isinstance(obj, BlockSenderBlock):
-                    obj.acks.timestamp = obj.timestamp
+                    if obj.ack_due > tnow:
+                        # held back to cover more chunks
+                        continue
+                    # echo the timestamp of the last chunk, plus the time we held
+                    # the ack so the sender does not count it in the RTT
+                    timestamp = obj.timestamp + (tnow - obj.recv_time)
+                    obj.acks.timestamp = timestamp
+                    obj.unacked = 0
+                    path = obj.path
                     if obj.complete():
                         #FIXME this is acking to the wrong address?
                         #ack = BlockSenderComplete(obj.block_id, obj.timestamp, obj.dest)
                         #self._send_object(ack, PKT_COMPLETE, obj.dest)
-                        ack = BlockSenderComplete(obj.block_id, obj.timestamp, (self.dest_ip,self.dest_port))
-                        self._send_object(ack, PKT_COMPLETE, (self.dest_ip,self.dest_port))
+                        (ack, type) = (BlockSenderComplete(obj.block_id, timestamp, (self.dest_ip,self.dest_port)),
+                                       PKT_COMPLETE)
+                    elif self.ack_format == 'bitmap' or (self.ack_format == 'auto' and
+                                                         obj.acks.prefer_bitmap()):
+                        (ack, type) = (BlockSenderSack(obj.acks), PKT_SACK)
                     else:
-                        pkt = obj.acks
                         #self._send_object(obj.acks, PKT_ACK, obj.dest)
-                        self._send_object(obj.acks, PKT_ACK, (self.dest_ip,self.dest_port))
+                        (ack, type) = (obj.acks, PKT_ACK)
                 else:
-                    (block_id, dest) = obj
+                    (block_id, dest, path) = obj
+                    # echo the timestamp of the chunk that prompted the ack, like a
+                    # block ack, so the sender gets a round trip time from it
+                    (timestamp, recv_time) = self.acks_needed[obj]
                     #ack = BlockSenderComplete(block_id, time.time(), dest)
                     #self._send_object(ack, PKT_COMPLETE, dest)
-                    ack = BlockSenderComplete(block_id, time.time(), (self.dest_ip,self.dest_port))
-                    self._send_object(ack, PKT_COMPLETE, (self.dest_ip,self.dest_port))
+                    (ack, type) = (BlockSenderComplete(block_id, timestamp + (tnow - recv_time),
+                                                       (self.dest_ip,self.dest_port)),
+                                   PKT_COMPLETE)
                     #print 'dest', dest
                     ###FIX ME wrong address? dest 
-                self.acks_needed.remove(obj)
+                if self.multi_ack:
+                    multi.setdefault(path, []).append((type, ack.pack()))
+                else:
+                    self._send_object(ack, type, (self.dest_ip,self.dest_port), path)
+                del self.acks_needed[obj]
             except Exception as e:
                 self._debug('_send_acks: ' + str(e))
                 return
+        for (path, packets) in multi.items():
+            self._send_multi(packets, path)
+
+    def _send_multi(self, packets, path):
+        '''send a list of (type, buf) packets packed into as few PKT_MULTI
+        packets as fit in the mss, or in a chunk sized packet if there is no mss'''
+        limit = self.mss or (self.chunk_size + self.chunk_overhead + PACKET_HEADER_SIZE)
+        limit -= PACKET_HEADER_SIZE
+        multi = BlockSenderMulti()
+        for (type, buf) in packets:
+            size = multi.entry_size + len(buf)
+            if multi.packets and multi.packed_size() + size > limit:
+                self._send_multi_packet(multi, path)
+                multi = BlockSenderMulti()
+            multi.packets.append((type, buf))
+        if multi.packets:
+            self._send_multi_packet(multi, path)
+
+    def _send_multi_packet(self, multi, path):
+        '''send a BlockSenderMulti, or its packet on its own if it only has one'''
+        dest = (self.dest_ip,self.dest_port)
+        if len(multi.packets) == 1:
+            (type, buf) = multi.packets[0]
+            self._send_object(buf, type, dest, path)
+        else:
+            self._send_object(multi, PKT_MULTI, dest, path)
+
+    def spool_path(self, block_id, partial=False):
+        '''return the spool file name for an incoming block, see spool_dir'''
+        spool_dir = self.spool_dir
+        if spool_dir is None:
+            spool_dir = self.journal.in_dir
+        if partial:
+            return os.path.join(spool_dir, '%u.part' % block_id)
+        return os.path.join(spool_dir, '%u.blk' % block_id)
+
+    def _spooled_for_caller(self, size):
+        '''return True if the caller asked for incoming blocks of size bytes to
+        be delivered in spool files. Other blocks are only spooled so that the
+        journal can resume them'''
+        return self.spool_dir is not None and size >= self.spool_threshold
+
+    def _new_incoming(self, obj, fromaddr):
+        '''create an incoming block from the header of a received packet'''
+        spool_path = None
+        if obj.size > 0 and (self.journal is not None or self._spooled_for_caller(obj.size)):
+            spool_path = self.spool_path(obj.block_id, partial=True)
+            if os.path.exists(spool_path):
+                # left over from a block we know nothing about
+                os.unlink(spool_path)
+        blk = BlockSenderBlock(obj.block_id, obj.size, obj.chunk_size, fromaddr, self.mss,
+                               spool_path=spool_path)
+        blk.create_time = self.clock()
+        #blk = BlockSenderBlock(obj.block_id, obj.size, obj.chunk_size, (self.dest_ip,self.dest_port), self.mss)
+        #FIXME fromaddr?
+        #print 'fromaddr',fromaddr
+        self.incoming.append(blk)
+        self.incoming_ids[blk.block_id] = blk
+        return blk
+
+    def _recover_chunk(self, blk, first, ack_to):
+        '''try to rebuild a lost chunk of an incoming block from the parity
+        for the group starting at chunk first'''
+        (count, parity) = blk.parity[first]
+        end = min(first + count, blk.num_chunks)
+        missing = None
+        for c in range(first, end):
+            if not blk.acks.present(c):
+                if missing is not None:
+                    # more than one chunk lost, wait for more data
+                    return
+                missing = c
+        del blk.parity[first]
+        if missing is None:
+            return
+        cs = blk.chunk_size
+        others = [blk.data[c*cs:min((c+1)*cs, blk.size)] for c in range(first, end) if c != missing]
+        data = _xor_buffers([parity] + others, cs)[:min(cs, blk.size - missing*cs)]
+        if self.enable_debug:
+            self._debug("recovered chunk %u of %u" % (missing, blk.block_id))
+        self.stats.recovered_chunks += 1
+        self._add_chunk(blk, BlockSenderChunk(blk.block_id, blk.size, missing, data, cs,
+                                              ack_to, blk.timestamp))
 
     def _add_chunk(self, blk, chunk, fill = None):
         '''add an incoming chunk to a block'''
-        
-        blk.acks.add(chunk.chunk_id, chunk.ack_to)
-        start = chunk.chunk_id*chunk.chunk_size
+        start = chunk.chunk_id*blk.chunk_size
         length = len(chunk.data)
+        if (chunk.size != blk.size or chunk.chunk_size != blk.chunk_size or
+            chunk.chunk_id >= blk.num_chunks or length != min(blk.chunk_size, blk.size - start)):
+            # a header that disagrees with the block would write outside it
+            self._debug('bad chunk %s for block of size %u chunk_size %u' % (
+                chunk, blk.size, blk.chunk_size))
+            self.stats.bad_packets += 1
+            return
+
+        was_complete = blk.complete()
+        blk.acks.add(chunk.chunk_id, chunk.ack_to)
         blk.data_length += length
     
-        blk.data[start:start+length] = chunk.data
+        if _old_buffer is not None and blk.spool_path is not None:
+            # python2 mmap slice assignment needs a string
+            blk.data[start:start+length] = _tobytes(chunk.data)
+        else:
+            blk.data[start:start+length] = chunk.data
         
-        self.acks_needed.add(blk)
+        blk.unacked += 1
+        # ack at once when a new gap shows a lost chunk, so the sender can resend it
+        self._need_ack(blk, immediate=(chunk.chunk_id > blk.last_chunk + 1 or blk.complete() or
+                                       (self.ack_every and blk.unacked >= self.ack_every)))
+        blk.last_chunk = max(blk.last_chunk, chunk.chunk_id)
+        if self.journal is not None and blk.spool_path is not None:
+            self.journal_dirty.add(blk)
+        if chunk.chunk_id == blk.contiguous:
+            self._prefix_grown(blk)
+        if not was_complete and blk.complete():
+            self.incoming_ready.append(blk)
+        elif blk.parity:
+            c = chunk.chunk_id
+            if blk.fec:
+                first = c - c % blk.fec
+            else:
+                # group size not known yet, look for a group holding this chunk
+                first = None
+                for (f, (count, parity)) in blk.parity.items():
+                    if f <= c < f + count:
+                        first = f
+            if first in blk.parity:
+                self._recover_chunk(blk, first, chunk.ack_to)
+
+    def _need_ack(self, blk, immediate=False):
+        '''schedule an ack for an incoming block, at most ack_delay after the
+        first chunk it will cover arrived'''
+        if blk not in self.acks_needed:
+            blk.ack_due = blk.recv_time + self.ack_delay
+            self.acks_needed[blk] = True
+        if immediate:
+            blk.ack_due = 0
+
+    def _prefix_grown(self, blk):
+        '''the chunk at the end of the received prefix of an incoming block
+        has arrived, note how far the prefix now reaches'''
+        blk.contiguous = blk.acks._next_clear(blk.contiguous)
+        if blk.codec != CODEC_NONE:
+            # a prefix of compressed data is no use to the caller
+            return
+        self.incoming_progress[blk.block_id] = blk
+        if self.progress_callback is not None:
+            self.progress_callback(blk.block_id, self._prefix_view(blk))
+
+    def _prefix_view(self, blk):
+        '''return a view of the received prefix of an incoming block, read-only
+        on pythons with memoryview.toreadonly()'''
+        length = min(blk.contiguous * blk.chunk_size, blk.size)
+        if _old_buffer is not None and blk.spool_path is not None:
+            return _old_buffer(blk.data, 0, length)
+        view = memoryview(blk.data)
+        if hasattr(view, 'toreadonly'):
+            view = view.toreadonly()
+        return view[:length]
+
+    def partial(self):
+        '''generate (block_id, view) for each incoming block whose received
+        prefix has grown since the last call. view is a read-only memoryview
+        of the data received so far without a gap from the start of the
+        block, which lets a progressive image be decoded before it is
+        complete. The final data is still returned by available()
+
+        Compressed blocks are only returned by available()
+        '''
+        with self.lock:
+            grown = list(self.incoming_progress.values())
+            self.incoming_progress.clear()
+            views = [(blk.block_id, self._prefix_view(blk)) for blk in grown]
+        for v in views:
+            yield v
 
     def _complete_send(self, blk):
         '''complete send of a block'''
         if blk.callback:
                         #print("Callback %s" % blk.callback)
             blk.callback()
+        for entry in blk.retransmit:
+            entry[2].chunk_delivered()
+            if blk.tuner is not None:
+                blk.tuner.chunk_delivered(blk.chunk_size)
+        if blk.create_time is not None:
+            self.stats.block_sent(blk, self.clock() - blk.create_time)
         efficiency = blk.num_chunks / float(blk.sends)
         #print("_complete_send: efficiency=%.2f sends=%u recvs=%u" % (efficiency, self.send_count, self.recv_count))
         self.efficiency = 0.95 * self.efficiency + 0.05 * efficiency
 
-    def _check_incoming(self):
-        '''check for incoming data or acks. Return True if a packet was received'''
-        try:
-            (buf, fromaddr) = self.sock.recvfrom(65536)
-        except socket.error:
-            return False
-        if len(buf) == 0:
-            return False
+    def _recv_batch(self, max_packets, path):
+        '''drain up to max_packets datagrams from a path's socket into the receive
+        buffer pool without processing them. Returns a list of (buf, fromaddr),
+        where buf is a memoryview that is only valid until the next call'''
+        packets = []
+        use_gro = self.use_gro and path is self.paths[0]
+        for i in range(min(max_packets, len(self.recv_buffers))):
+            try:
+                if use_gro:
+                    (n, ancdata, flags, fromaddr) = path.sock.recvmsg_into([self.recv_buffers[i]],
+                                                                           self.gro_cmsg_size)
+                elif path.use_recv_into:
+                    (n, fromaddr) = path.sock.recvfrom_into(self.recv_buffers[i])
+                else:
+                    (buf, fromaddr) = path.sock.recvfrom(MAX_PACKET_SIZE)
+                    n = len(buf)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.stats.recv_errors += 1
+                break
+            if n == 0:
+                break
+            if not path.use_recv_into and not use_gro:
+                packets.append((memoryview(buf), fromaddr))
+                continue
+            view = self.recv_views[i]
+            segment = n
+            if use_gro:
+                for (level, type, data) in ancdata:
+                    if level == _SOL_UDP and type == _UDP_GRO:
+                        (segment,) = struct.unpack_from('i', data)
+            # a GRO buffer holds several datagrams of segment bytes each
+            for ofs in range(0, n, max(segment, 1)):
+                packets.append((view[ofs:min(ofs+segment, n)], fromaddr))
+        return packets
+
+    def _check_incoming(self, max_packets=1):
+        '''check for incoming data or acks. Return the number of packets received'''
+        count = 0
+        for path in self.paths:
+            while count < max_packets:
+                want = max_packets - count
+                packets = self._recv_batch(want, path)
+                for (buf, fromaddr) in packets:
+                    self._process_packet(buf, fromaddr, path)
+                count += len(packets)
+                if len(packets) < min(want, len(self.recv_buffers)):
+                    # the socket has been drained
+                    break
+        return count
+
+    def _process_packet(self, buf, fromaddr, path=None):
+        '''process one received packet, which arrived on path (default the primary path)'''
+        if path is None:
+            path = self.paths[0]
         self.recv_count += 1
+        path.recv_count += 1
         if self.dest_ip is None:
             if self.enable_debug:
                 self._debug('connection from %s' % str(fromaddr))
@@ -487,102 +2886,227 @@ class BlockSender:
             (self.dest_ip,self.dest_port) = fromaddr
         try:
             if len(buf) < PACKET_HEADER_SIZE:
-                self._debug('bad packet %s' % msg)
-                return True
+                self._debug('bad packet length %u' % len(buf))
+                self.stats.bad_packets += 1
+                return
             (magic,crc) = struct.unpack_from('<BL', buf)
             remaining = buf[PACKET_HEADER_SIZE:]
             if crc != self._crc(remaining):
                 self._debug('bad crc')
-                return True                
+                self.stats.crc_errors += 1
+                return                
+            if magic < len(_PKT_NAMES):
+                self.stats.packets_recv[magic] += 1
+                self.stats.bytes_recv[magic] += len(buf)
+            if magic == PKT_MULTI:
+                multi = BlockSenderMulti()
+                multi.unpack(remaining)
+        except Exception as e:
+            self._debug('_check_incoming: bad packet %s' % str(e))
+            self.stats.bad_packets += 1
+            return
+        if magic != PKT_MULTI:
+            self._process_object(magic, remaining, fromaddr, path)
+            return
+        for (magic, payload) in multi.packets:
+            self._process_object(magic, payload, fromaddr, path)
+
+    def _rtt_sample(self, timestamp, path, tnow):
+        '''take a round trip time sample from the timestamp echoed in an ack,
+        updating the RTT estimates and statistics. Returns the round trip
+        time, or None if it is not positive'''
+        rtt = tnow - timestamp
+        if rtt <= 0:
+            return None
+        if not self.rtt_sampled:
+            # the first sample replaces the configured guess
+            self.rtt_sampled = True
+            self.rtt_estimate = min(self.rtt_max, rtt)
+        if not path.rtt_sampled:
+            path.rtt_sampled = True
+            path.rtt_estimate = min(self.rtt_max, rtt)
+        self.rtt_estimate = min(self.rtt_max, 0.95 * self.rtt_estimate + 0.05 * rtt)
+        path.rtt_estimate = min(self.rtt_max, 0.95 * path.rtt_estimate + 0.05 * rtt)
+        self.stats.rtt(rtt)
+        return rtt
+
+    def _process_object(self, magic, remaining, fromaddr, path):
+        '''process the payload of one received packet of type magic'''
+        try:
             if magic == PKT_ACK:
                 obj = BlockSenderSet(0,0,0)
                 obj.unpack(remaining)
+            elif magic == PKT_SACK:
+                obj = BlockSenderSet(0,0,0)
+                obj.unpack_bitmap(remaining)
             elif magic == PKT_COMPLETE:
                 obj = BlockSenderComplete(0, None, None)
                 obj.unpack(remaining)
             elif magic == PKT_CHUNK:
                 obj = BlockSenderChunk(0, 0, 0, "", 0, 0, 0)
                 obj.unpack(remaining)
+            elif magic == PKT_CHUNK_CODEC:
+                obj = BlockSenderChunk(0, 0, 0, "", 0, 0, 0, codec=CODEC_ZLIB)
+                obj.unpack(remaining)
+            elif magic == PKT_PARITY:
+                obj = BlockSenderParity(0, 0, 0, 0, None, 0, 0, 0)
+                obj.unpack(remaining)
+            elif magic == PKT_PARITY_CODEC:
+                obj = BlockSenderParity(0, 0, 0, 0, None, 0, 0, 0, codec=CODEC_ZLIB)
+                obj.unpack(remaining)
+            elif magic == PKT_CANCEL:
+                obj = BlockSenderCancel(0)
+                obj.unpack(remaining)
             else:
                 self._debug('bad magic %u' % magic)
-                return True
+                self.stats.bad_packets += 1
+                return
         except Exception as e:
             self._debug('_check_incoming: bad packet %s' % str(e))
-            return True
-        tnow = time.time()
+            self.stats.bad_packets += 1
+            return
+        tnow = self.clock()
                 #print(obj)
         if isinstance(obj, BlockSenderSet):
             # we've received a set of acks for some data
             # find the corresponding outgoing block
-            self.rtt_estimate = min(self.rtt_max, 0.95 * self.rtt_estimate + 0.05 * (tnow - obj.timestamp))
-            for i in range(len(self.outgoing)):
-                out = self.outgoing[i]
-                if out.block_id == obj.id:
-                    if self.enable_debug:
-                        self._debug("ack %s %f" % (str(out.acks), tnow - obj.timestamp))
+            rtt = self._rtt_sample(obj.timestamp, path, tnow)
+            out = self.outgoing_ids.get(obj.id, None)
+            if out is not None:
+                if self.enable_debug:
+                    self._debug("ack %s %f" % (str(out.acks), tnow - obj.timestamp))
+                acked = out.acks.count
+                if out.resumed:
+                    # the first ack after resuming from the journal lists every chunk
+                    # the receiver holds, as we sent it chunks with ack_to zero. Trust
+                    # it over the journal and go back over anything it lacks
+                    try:
+                        out.acks.set_bits(obj.bits)
+                    except BlockSenderException:
+                        out.acks.update(obj)
+                    out.resumed = False
+                    out.next_chunk = 0
+                else:
                     out.acks.update(obj)
-                    if out.acks.complete():
-                        if self.enable_debug:
-                            self._debug("send complete %u %s" % (out.block_id, obj))
-                        blk = self.outgoing.pop(i)
-                        self._complete_send(blk)
-                    return True
+                if self.journal is not None:
+                    self.journal_dirty.add(out)
+                if rtt is not None:
+                    path.rate_control.on_ack(path, rtt, max(out.acks.count - acked, 0) * out.chunk_size,
+                                             tnow)
+                if out.acks.complete():
+                    if self.enable_debug:
+                        self._debug("send complete %u %s" % (out.block_id, obj))
+                    self._remove_outgoing(out)
+                    self._complete_send(out)
+                return
+            if obj.id in self.cancelled:
+                # the receiver missed our cancel
+                self._send_cancel(obj.id, fromaddr, path)
             # an ack for something already complete
-            return True
+            return
 
         if isinstance(obj, BlockSenderComplete):
             # a full block has been received
             if self.enable_debug:
                 self._debug("full ack for block_id %u" % obj.block_id)
-            self.rtt_estimate = min(self.rtt_max, 0.95 * self.rtt_estimate + 0.05 * (tnow - obj.timestamp))
-            for i in range(len(self.outgoing)):
-                out = self.outgoing[i]
-                if out.block_id == obj.block_id:
-                    blk = self.outgoing.pop(i)
-                    if self.enable_debug:
-                        self._debug("send complete %u outlen=%u %s %s" % (
-                                                        out.block_id, len(self.outgoing), obj, blk))
-                    self._complete_send(blk)
-                    return True
+            rtt = self._rtt_sample(obj.timestamp, path, tnow)
+            blk = self.outgoing_ids.get(obj.block_id, None)
+            if blk is not None:
+                if rtt is not None:
+                    path.rate_control.on_ack(path, rtt, (blk.num_chunks - blk.acks.count) * blk.chunk_size,
+                                             tnow)
+                self._remove_outgoing(blk)
+                if self.enable_debug:
+                    self._debug("send complete %u outlen=%u %s %s" % (
+                                                    blk.block_id, len(self.outgoing), obj, blk))
+                self._complete_send(blk)
+                return
             # an ack for something already complete
-            return True
+            return
 
         if isinstance(obj, BlockSenderChunk):
             # we've received a chunk of data
-            if obj.block_id in self.completed:
+            self.stats.chunks_recv += 1
+            if self.completed.hit(obj.block_id):
                 # we've already completed this block_id
+                self.stats.dup_chunks += 1
                 if self.enable_debug:
                     self._debug("got completed chunk %u of %u" % (obj.chunk_id, obj.block_id))
-                self.acks_needed.add((obj.block_id, fromaddr))
-                #self.acks_needed.add((obj.block_id, (self.dest_ip,self.dest_port)))
+                self.acks_needed[(obj.block_id, fromaddr, path)] = (obj.timestamp, tnow)
+                #self.acks_needed.add((obj.block_id, (self.dest_ip,self.dest_port), path))
                 #FIXME fromaddr
-                return True
-            for i in range(len(self.incoming)):
-                blk = self.incoming[i]
-                if blk.block_id == obj.block_id:
-                    # we have an existing incoming object
+                return
+            blk = self.incoming_ids.get(obj.block_id, None)
+            if blk is not None:
+                # we have an existing incoming object
+                if blk.acks.present(obj.chunk_id):
+                    self.stats.dup_chunks += 1
                     if self.enable_debug:
-                        if obj.chunk_id in blk.acks.chunks:
-                            self._debug("got dup chunk %u of %u" % (obj.chunk_id, obj.block_id))
-                        else:
-                            self._debug("got chunk %u of %u" % (obj.chunk_id, obj.block_id))
-                    blk.timestamp = obj.timestamp
-                    self._add_chunk(blk, obj)
-                    return True
+                        self._debug("got dup chunk %u of %u" % (obj.chunk_id, obj.block_id))
+                elif self.enable_debug:
+                    self._debug("got chunk %u of %u" % (obj.chunk_id, obj.block_id))
+                blk.timestamp = obj.timestamp
+                blk.recv_time = tnow
+                blk.path = path
+                blk.codec = obj.codec
+                self._add_chunk(blk, obj)
+                return
             # its a new block
             if self.enable_debug:
                 self._debug("new block chunk %u of %u (size=%u chunk_size=%u)" % (
                                         obj.chunk_id, obj.block_id, obj.size, obj.chunk_size))
-            self.incoming.append(BlockSenderBlock(obj.block_id, obj.size, obj.chunk_size, fromaddr, self.mss))
-            #self.incoming.append(BlockSenderBlock(obj.block_id, obj.size, obj.chunk_size, (self.dest_ip,self.dest_port), self.mss))
-            #FIXME fromaddr?
-            #print 'fromaddr',fromaddr
-            blk = self.incoming[-1]
+            if obj.chunk_size == 0:
+                self._debug('bad chunk %s' % obj)
+                self.stats.bad_packets += 1
+                return
+            blk = self._new_incoming(obj, fromaddr)
             blk.timestamp = obj.timestamp
+            blk.recv_time = tnow
+            blk.path = path
+            blk.codec = obj.codec
             self._add_chunk(blk, obj)
-            return True
+            return
+
+        if isinstance(obj, BlockSenderParity):
+            # parity for a group of chunks
+            if self.completed.hit(obj.block_id):
+                self.acks_needed[(obj.block_id, fromaddr, path)] = (obj.timestamp, tnow)
+                return
+            blk = self.incoming_ids.get(obj.block_id, None)
+            if blk is None:
+                if obj.chunk_size == 0:
+                    self._debug('bad parity %s' % obj)
+                    self.stats.bad_packets += 1
+                    return
+                blk = self._new_incoming(obj, fromaddr)
+            if blk.complete() or obj.count == 0:
+                return
+            blk.timestamp = obj.timestamp
+            blk.recv_time = tnow
+            blk.path = path
+            blk.codec = obj.codec
+            if obj.first == 0 or obj.first + obj.count < blk.num_chunks:
+                # only the last group can be short
+                blk.fec = obj.count
+            blk.parity[obj.first] = (obj.count, _tobytes(obj.data))
+            self._recover_chunk(blk, obj.first, obj.ack_to)
+            self._need_ack(blk)
+            return
+
+        if isinstance(obj, BlockSenderCancel):
+            # the sender gave up on a block
+            blk = self.incoming_ids.get(obj.block_id, None)
+            if blk is not None and not blk.complete():
+                if self.enable_debug:
+                    self._debug("cancelled block %u with %u/%u chunks" % (
+                        blk.block_id, blk.acks.count, blk.num_chunks))
+                self._remove_incoming(blk)
+            if blk is None or not blk.complete():
+                # ignore any chunks still on their way
+                self.completed.add(obj.block_id)
+            return
         self._debug("unexpected incoming packet type")
-        return True
+        return
 
 
     def available(self, ordered=None):
@@ -590,43 +3114,132 @@ class BlockSender:
 
         This does no network operations
         '''
+        block = self.available_block(ordered)
+        if block is None:
+            return None
+        return block[1]
+
+    def available_block(self, ordered=None):
+        '''return (block_id, data) for the first incoming block if completed
+        or None. Each completed block is returned once, by either this or
+        available()
+
+        This does no network operations
+        '''
+        if self.delivery is not None:
+            try:
+                return self.delivery.get_nowait()
+            except queue.Empty:
+                return None
+        if self.undelivered:
+            return self.undelivered.popleft()
         if ordered is None:
             ordered = self.ordered
-        imax = len(self.incoming)
+        blk = self._pop_completed(ordered)
+        if blk is None:
+            return None
+        return (blk.block_id, blk.data)
+
+    def _remove_incoming(self, blk):
+        '''discard an incomplete incoming block'''
+        self.incoming.remove(blk)
+        del self.incoming_ids[blk.block_id]
+        self.incoming_progress.pop(blk.block_id, None)
+        self.acks_needed.pop(blk, None)
+        if self.journal is not None:
+            self.journal_dirty.discard(blk)
+            self.journal.remove_incoming(blk.block_id)
+        if blk.spool_path is not None:
+            self._discard_spool(blk)
+            blk.data = None
+
+    def _discard_spool(self, blk):
+        '''close and delete the spool file of an incoming block. While the
+        caller still holds views on it from partial() or progress_callback
+        the mapping can't be closed, it is then freed with the last view'''
+        try:
+            blk.data.close()
+        except BufferError:
+            pass
+        try:
+            os.unlink(blk.spool_path)
+        except OSError:
+            pass
+        blk.spool_path = None
+
+    def _pop_completed(self, ordered):
+        '''remove and return the next completed incoming block, or None'''
         if ordered:
-            imax = min(1, imax)
-        for i in range(imax):
-            if self.incoming[i].complete():
-                blk = self.incoming.pop(i)
-                print("available sends=%u recvs=%u" % (self.send_count, self.recv_count))
-                self.completed.append(blk.block_id)
-                self.completed2.append((blk.block_id, blk.data))
-                #add completed block call back here
-                #fixme
-                while len(self.completed) > self.completed_len:
-                    self.completed.pop(0)        
-                return blk.data
-        return None
+            if len(self.incoming) == 0 or not self.incoming[0].complete():
+                return None
+            blk = self.incoming[0]
+            self.incoming_ready.remove(blk)
+        elif len(self.incoming_ready) > 0:
+            blk = self.incoming_ready.popleft()
+        else:
+            return None
+        self.incoming.remove(blk)
+        del self.incoming_ids[blk.block_id]
+        self.incoming_progress.pop(blk.block_id, None)
+        if self.journal is not None:
+            self.journal_dirty.discard(blk)
+            self.journal.remove_incoming(blk.block_id)
+        if self.enable_debug:
+            self._debug("available sends=%u recvs=%u" % (self.send_count, self.recv_count))
+        self.completed.add(blk.block_id)
+        if blk.create_time is not None:
+            self.stats.block_received(self.clock() - blk.create_time)
+        if blk.codec != CODEC_NONE:
+            try:
+                data = _decompress(_tobytes(blk.data), blk.codec)
+            except Exception as e:
+                self._debug('block %u failed to decompress: %s' % (blk.block_id, str(e)))
+                data = None
+            if blk.spool_path is not None:
+                # the uncompressed data is on the heap anyway
+                self._discard_spool(blk)
+            if data is None:
+                return self._pop_completed(ordered)
+            blk.data = data
+            blk.codec = CODEC_NONE
+        elif blk.spool_path is not None and not self._spooled_for_caller(blk.size):
+            # spooled for the journal only
+            data = bytearray(blk.data)
+            self._discard_spool(blk)
+            blk.data = data
+        elif blk.spool_path is not None:
+            blk.data.flush()
+            path = self.spool_path(blk.block_id)
+            os.rename(blk.spool_path, path)
+            blk.spool_path = path
+        #add completed block call back here
+        #fixme
+        return blk
 
     def report(self, detailed=False):
         '''report chunk status'''
         total_acked = 0
         total_chunks = 0
-        for i in range(len(self.outgoing)):
-            blk = self.outgoing[i]
-            total_acked += len(blk.acks.chunks)
+        for blk in self.outgoing:
+            total_acked += blk.acks.count
             total_chunks += blk.acks.num_chunks
             if detailed:
-                print("block %u  acked %u/%u" % (blk.block_id, len(blk.acks.chunks), blk.acks.num_chunks))
-                print("block %u  acked %f" % (blk.block_id, (float(len(blk.acks.chunks))/float(blk.acks.num_chunks))*100.))                
+                print("block %u  acked %u/%u" % (blk.block_id, blk.acks.count, blk.acks.num_chunks))
+                print("block %u  acked %f" % (blk.block_id, (float(blk.acks.count)/float(blk.acks.num_chunks))*100.))                
                 complete = "0"
                 if len(self.incoming) > 0:
-                    complete = "%u/%u" % (len(self.incoming[0].acks.chunks), self.incoming[0].acks.num_chunks)
+                    complete = "%u/%u" % (self.incoming[0].acks.count, self.incoming[0].acks.num_chunks)
                     print("total_acked=%u total_chunks=%u eff=%.2f rtt=%.1f bw=%.2f qsize=%u in=%u/%s" % (
                             total_acked, total_chunks, self.get_efficiency(), self.get_rtt_estimate(),
                             self.get_bandwidth_used(),
                             self.sendq_size(), len(self.incoming), complete))
-        print ""
+        for tuner in self.chunk_tuners.values():
+            print("dest %s chunk_size=%u mtu=%s" % (str(tuner.dest), tuner.chunk_size(), str(tuner.mtu)))
+        if len(self.outgoing.channels) > 1:
+            for channel in self.outgoing.channels.values():
+                print("channel %s weight=%s queued=%u sent=%u" % (channel.name, channel.weight,
+                                                                   len(channel.queue), channel.bytes_sent))
+        print("")
                 
     def sendq_size(self):
         '''return number of uncompleted blocks in the send queue'''
@@ -639,26 +3252,40 @@ class BlockSender:
         timeout:  time to wait for a packet (0 means to return immediately)
         ordered:  return blocks in same order as sent (default False)
         '''
+        block = self.recv_block(timeout, ordered)
+        if block is None:
+            return None
+        return block[1]
+
+    def recv_block(self, timeout=0, ordered=None):
+        '''receive next chunk from network. Return (block_id, data) for a
+        completed block or None, see recv()'''
+        if self.delivery is not None:
+            # the background thread is receiving
+            try:
+                return self.delivery.get(timeout=max(timeout, 0.000001))
+            except queue.Empty:
+                return None
         if ordered is None:
             ordered = self.ordered
-        data = self.available(ordered=ordered)
-        if data is not None:
-            return data
-        if len(self.incoming) > 0 and self.incoming[0].complete():
-            return self.incoming.pop(0).data            
+        block = self.available_block(ordered=ordered)
+        if block is not None:
+            return block
         if timeout != 0:
-            rin = [self.sock.fileno()]
+            rin = [p.sock.fileno() for p in self.paths]
             try:
                 (rin, win, xin) = select.select(rin, [], [], timeout)
             except select.error:
                 return None
-        self._check_incoming()
-        return self.available(ordered=ordered)
+        self._check_incoming(self.backlog)
+        return self.available_block(ordered=ordered)
 
 
     def reset_timer(self):
         '''reset the timer used for bandwidth control'''
-        self.last_send_time = time.time()
+        self.last_send_time = self.clock()
+        for path in self.paths:
+            path.last_token_time = self.last_send_time
 
 
     def _send_outgoing(self, max_queue=None):
@@ -666,78 +3293,290 @@ class BlockSender:
         if len(self.outgoing) == 0:
             return
 
-        tnow = time.time()
+        tnow = self.clock()
         deltat = tnow - self.last_send_time
-        bytes_to_send = int(self.bandwidth * deltat)
+        for tuner in self.chunk_tuners.values():
+            tuner.probe(tnow)
+        # fill the token bucket of each path at its send rate. Unused tokens
+        # carry over to the next tick, up to the bucket size
+        multipath = len(self.paths) > 1
+        bucket_size = self._bucket_size()
+        for path in self.paths:
+            path.rate_control.update(path, tnow)
+            path.tokens = min(path.tokens + path.rate(tnow, multipath) * (tnow - path.last_token_time),
+                              bucket_size)
+            path.last_token_time = tnow
+        bytes_to_send = int(sum([p.tokens for p in self.paths]))
         if bytes_to_send <= 0:
             return
+        if self.batch_sender is not None:
+            self.tx_pending = []
+            self.tx_chunks = []
+
+        # chunks sent before this time without being acked are due for resend
+        rto_cutoff = tnow - self._rto()
+
+        channels = [c for c in self.outgoing.channels.values() if len(c.queue)]
+        if len(channels) == 1:
+            (bytes_sent, chunks_sent, idle) = self._send_queue(channels[0].queue, tnow, rto_cutoff,
+                                                               bytes_to_send, self.backlog, max_queue)
+            channels[0].bytes_sent += bytes_sent
+        else:
+            bytes_sent = self._send_channels(channels, tnow, rto_cutoff, bytes_to_send, max_queue)
+
+        self._flush_sends()
+
+        if bytes_sent != 0:
+            self.bandwidth_used = 0.99 * self.bandwidth_used + 0.01 * (bytes_sent/deltat)
+            self.last_send_time = tnow
+
+
+    def _send_queue(self, queue, tnow, rto_cutoff, budget, max_chunks, max_queue=None):
+        '''send the chunks that are due from the blocks of one queue, up to budget
+        bytes and max_chunks chunks. Returns (bytes_sent, chunks_sent, idle) where
+        idle is True if the queue had nothing more due'''
         bytes_sent = 0
         chunks_sent = 0
+        idle = True
 
-        # we can get bonus bytes to send from the previous tick, due to the granularity of
-        # the chunk size
-        bytes_to_send += min(self.bonus_bytes, self.chunk_size)
-
-        count = len(self.outgoing)
+        count = len(queue)
         if max_queue is not None:
             count = min(max_queue, count)
 
-        for i in range(count):
-            blk = self.outgoing[i]
+        prev = None
+        for blk in queue.walk():
+            if count == 0:
+                idle = False
+                break
+            count -= 1
 
             # in order to preserve ordering, we have to make sure the other end
             # has acked at least one chunk from the previous block before moving
             # to the next block
-            if self.ordered and i > 0 and not self.outgoing[i-1].acks.started():
+            if self.ordered and prev is not None and not prev.acks.started():
+                idle = False
                 break
+            prev = blk
 
-            # start where we left off
-            chunks = list(range(blk.next_chunk, blk.num_chunks))
-            chunks.extend(range(blk.next_chunk))
-    
-            for c in chunks:
-                
-                if blk.acks.present(c):
-                    # we've received an ack for this chunk already
+            if (chunks_sent >= max_chunks or
+                bytes_sent + self.chunk_overhead + 1 > budget):
+                # nothing more can be sent this tick
+                idle = False
+                break
+
+            while chunks_sent < max_chunks:
+                if blk.parity_pending:
+                    parity = self._make_parity(blk, blk.parity_pending[0], tnow)
+                    if parity is None:
+                        # the whole group has already been acked
+                        blk.parity_pending.popleft()
+                        continue
+                    path = None
+                    if bytes_sent + parity.packed_size <= budget:
+                        path = self._choose_path(parity.packed_size)
+                    if path is None:
+                        idle = False
+                        break
+                    try:
+                        self._send_object(parity, parity.packet_type(), blk.dest, path)
+                    except Exception as e:
+                        self._debug('_send_outgoing: ' + str(e))
+                        break
+                    blk.parity_pending.popleft()
+                    bytes_sent += parity.packed_size
+                    path.tokens -= parity.packed_size
+                    chunks_sent += 1
                     continue
-                if bytes_sent + blk.chunk_size > bytes_to_send:
-                    # this would take us over our bandwidth limit
+
+                (c, entry) = self._next_due_chunk(blk, rto_cutoff)
+                if c is None:
+                    # nothing in this block is due to be sent
                     break
-                if c in blk.chunk_send_times:
-                    if tnow - blk.chunk_send_times[c] < self.rtt_multiplier*self.rtt_estimate:
-                        # wait for a possible ack
-                        continue
 
                 chunk = BlockSenderChunk(blk.block_id, blk.size, c, blk.chunk(c),
-                             blk.chunk_size, blk.acks.first_missing, tnow)
-                
+                             blk.chunk_size, self._ack_to(blk), tnow, blk.codec)
 
-                if bytes_sent + chunk.packed_size > bytes_to_send:
+                path = None
+                if bytes_sent + chunk.packed_size <= budget:
+                    path = self._choose_path(chunk.packed_size)
+                if path is None:
                     # this would take us over our bandwidth limit
+                    self._unget_chunk(blk, c, entry)
+                    idle = False
                     break
 
+                queued = None
+                if self.tx_pending is not None:
+                    queued = len(self.tx_pending)
                 try:
-                    self._send_object(chunk, PKT_CHUNK, blk.dest)
+                    self._send_object(chunk, chunk.packet_type(), blk.dest, path)
                 except Exception as e:
                     self._debug('_send_outgoing: ' + str(e))
+                    self._unget_chunk(blk, c, entry)
                     break
                                 #print("sent chunk size=%u of %u sends=%u block_id=%u" % (
                                 #        chunk.chunk_size, blk.size, blk.sends, blk.block_id))
+                if entry is not None:
+                    # the ack for this chunk timed out
+                    entry[2].chunk_lost(tnow)
+                    if blk.tuner is not None:
+                        blk.tuner.chunk_lost(blk.chunk_size)
+                    self.stats.retransmits += 1
+                self.stats.chunks_sent += 1
                 bytes_sent += chunk.packed_size
-                blk.next_chunk = (c + 1) % blk.num_chunks
+                path.tokens -= chunk.packed_size
                 blk.timestamp = tnow
                 blk.sends += 1
                 chunks_sent += 1
-                blk.chunk_send_times[c] = tnow
-                if chunks_sent == self.backlog:
-                    # don't send more than self.backlog per tick
-                    break
-
-        self.bonus_bytes = bytes_to_send - bytes_sent
-        if bytes_sent != 0:
-            self.bandwidth_used = 0.99 * self.bandwidth_used + 0.01 * (bytes_sent/deltat)
-            self.last_send_time = tnow
-
+                sent = (tnow, c, path)
+                blk.retransmit.append(sent)
+                group = None
+                if blk.fec and entry is None and ((c+1) % blk.fec == 0 or c+1 == blk.num_chunks):
+                    # first send of the last chunk of a parity group
+                    group = c - c % blk.fec
+                    blk.parity_pending.append(group)
+                if queued is not None and len(self.tx_pending) > queued:
+                    # held for a batched send, which may not all go out
+                    self.tx_chunks.append((queued, blk, c, entry, sent, chunk.packed_size, group))
+
+        return (bytes_sent, chunks_sent, idle)
+
+    def _send_channels(self, channels, tnow, rto_cutoff, bytes_to_send, max_queue):
+        '''share bytes_to_send between the busy channels. Each is first served
+        up to its minimum rate, then the rest is shared by deficit round robin
+        in proportion to the channel weights. Returns the bytes sent'''
+        bytes_sent = 0
+        chunks_sent = 0
+        bucket_size = self._bucket_size()
+        for channel in channels:
+            if channel.min_rate:
+                if channel.last_time is not None:
+                    channel.min_tokens = min(channel.min_tokens + channel.min_rate * (tnow - channel.last_time),
+                                             bucket_size)
+                channel.last_time = tnow
+                if channel.min_tokens <= 0:
+                    continue
+                (nbytes, nchunks, idle) = self._send_queue(channel.queue, tnow, rto_cutoff,
+                                                           min(channel.min_tokens, bytes_to_send - bytes_sent),
+                                                           self.backlog - chunks_sent, max_queue)
+                if idle:
+                    # don't save up a minimum rate the channel has no use for
+                    channel.min_tokens = 0
+                else:
+                    channel.min_tokens -= nbytes
+                channel.bytes_sent += nbytes
+                bytes_sent += nbytes
+                chunks_sent += nchunks
+
+        # deficit round robin. Each visit tops a channel up by a quantum in
+        # proportion to its weight, the lightest busy channel getting one full
+        # chunk, and it sends while its deficit lasts. The channel the budget
+        # ran out on is visited first next tick
+        active = channels
+        min_weight = min([c.weight for c in active])
+        quantum = self.chunk_size + self.chunk_overhead + 1
+        names = [c.name for c in active]
+        i = 0
+        if self.outgoing.drr_next in names:
+            i = names.index(self.outgoing.drr_next)
+        while active and chunks_sent < self.backlog:
+            i %= len(active)
+            channel = active[i]
+            if not channel.topped:
+                channel.deficit += quantum * channel.weight / float(min_weight)
+                channel.topped = True
+            remaining = bytes_to_send - bytes_sent
+            (nbytes, nchunks, idle) = self._send_queue(channel.queue, tnow, rto_cutoff,
+                                                       min(channel.deficit, remaining),
+                                                       self.backlog - chunks_sent, max_queue)
+            channel.min_tokens = max(channel.min_tokens - nbytes, 0)
+            channel.bytes_sent += nbytes
+            bytes_sent += nbytes
+            chunks_sent += nchunks
+            if idle:
+                # nothing more is due on this channel, it doesn't keep its deficit
+                channel.deficit = 0
+                channel.topped = False
+                active.pop(i)
+                continue
+            if channel.deficit >= remaining:
+                # out of bandwidth for this tick
+                channel.deficit -= nbytes
+                self.outgoing.drr_next = channel.name
+                break
+            channel.deficit -= nbytes
+            channel.topped = False
+            i += 1
+        return bytes_sent
+
+    def _choose_path(self, size):
+        '''return the path to send a packet of size bytes on, or None if no
+        path has the tokens for it. The path with the most tokens wins,
+        discounted by its loss rate'''
+        best = None
+        for path in self.paths:
+            if path.tokens >= size and (best is None or
+                                        path.tokens * (1 - path.loss) > best.tokens * (1 - best.loss)):
+                best = path
+        return best
+
+    def _make_parity(self, blk, first, tnow):
+        '''return a parity packet for the group of an outgoing block starting at
+        chunk first, or None if all of the group has been acked'''
+        end = min(first + blk.fec, blk.num_chunks)
+        for c in range(first, end):
+            if not blk.acks.present(c):
+                break
+        else:
+            return None
+        data = _xor_buffers([blk.chunk(c) for c in range(first, end)], blk.chunk_size)
+        return BlockSenderParity(blk.block_id, blk.size, first, end - first, data,
+                                 blk.chunk_size, self._ack_to(blk), tnow, blk.codec)
+
+    def _ack_to(self, blk):
+        '''return the chunk the receiver's acks for an outgoing block may start
+        at. A resumed block asks for all of them'''
+        if blk.resumed:
+            return 0
+        return blk.acks.first_missing
+
+    def _next_due_chunk(self, blk, rto_cutoff):
+        '''return (chunk_id, entry) for the next chunk of a block that is due to
+        be sent, or (None, None). Chunks whose retransmit timer has expired
+        come first, then chunks that have never been sent. Until an ack has
+        given a round trip time sample the retransmit timeout is only a
+        guess, so the order is reversed. entry is the retransmit queue
+        entry, for _unget_chunk()'''
+        if self.rtt_sampled:
+            (c, entry) = self._next_resend(blk, rto_cutoff)
+            if c is not None:
+                return (c, entry)
+        while blk.next_chunk < blk.num_chunks:
+            c = blk.next_chunk
+            blk.next_chunk += 1
+            if not blk.acks.present(c):
+                return (c, None)
+        return self._next_resend(blk, rto_cutoff)
+
+    def _next_resend(self, blk, rto_cutoff):
+        '''return (chunk_id, entry) for the next chunk of a block whose
+        retransmit timer has expired, or (None, None)'''
+        q = blk.retransmit
+        while q and q[0][0] <= rto_cutoff:
+            entry = q.popleft()
+            if not blk.acks.present(entry[1]):
+                return (entry[1], entry)
+            entry[2].chunk_delivered()
+            if blk.tuner is not None:
+                blk.tuner.chunk_delivered(blk.chunk_size)
+        return (None, None)
+
+    def _unget_chunk(self, blk, chunk_id, entry):
+        '''put back a chunk returned by _next_due_chunk() that was not sent'''
+        if entry is not None:
+            blk.retransmit.appendleft(entry)
+        else:
+            blk.next_chunk = chunk_id
 
     def tick(self, packet_count=None, send_acks=True, send_outgoing=True, max_queue=None):
         '''periodic timer to trigger data sends
@@ -752,9 +3591,10 @@ class BlockSender:
         # check for incoming packets
         if packet_count is None:
             packet_count = self.backlog
-        for i in range(packet_count):
-            if not self._check_incoming():
-                break
+        self._check_incoming(packet_count)
+
+        # drop blocks that are past their deadline
+        self._expire_blocks()
 
         # send any acks that are needed
         if send_acks:
@@ -763,3 +3603,6 @@ class BlockSender:
         # send outgoing data
         if send_outgoing:
             self._send_outgoing(max_queue=max_queue)
+
+        self._flush_journal()
+        self._log_stats()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+asyncio front end for block_sender
+
+AsyncBlockSender drives a block_sender.BlockSender from an asyncio event
+loop instead of a polling loop. The sender's socket is registered with
+the loop as a datagram endpoint, received packets are processed as they
+arrive, and acks and paced chunk sends are scheduled with loop.call_at().
+Only the primary path is registered with the loop, paths added with
+BlockSender.add_path() are not read.
+
+    link = await AsyncBlockSender.create(dest_ip='10.7.7.1', port=7000, dest_port=6000)
+    await link.send(data, priority=2)      # resolves when the block is acked
+    async for data in link:                # completed incoming blocks
+        ...
+
+This module needs python 3.7 or later.
+'''
+
+import asyncio
+import block_sender
+
+# put on the incoming queue when the link closes, to wake readers
+_CLOSED = object()
+
+
+class BlockSenderProtocol(asyncio.DatagramProtocol):
+    '''datagram protocol feeding received packets to an AsyncBlockSender'''
+    def __init__(self, link):
+        self.link = link
+
+    def datagram_received(self, data, addr):
+        self.link._packet_received(data, addr)
+
+    def error_received(self, exc):
+        self.link.sender._debug('error_received: %s' % str(exc))
+
+    def connection_lost(self, exc):
+        self.link._connection_lost(exc)
+
+
+class AsyncBlockSender:
+    '''an asyncio wrapper around a BlockSender
+
+    sender: the BlockSender to drive. Its socket must be a real socket, it
+            is handed to the event loop
+    loop:   the event loop (default the running loop)
+
+    The sender is only touched under its lock, but the event loop reads
+    the socket itself, so don't also call start() on the sender.
+    '''
+    def __init__(self, sender, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.sender = sender
+        self.loop = loop
+        self.transport = None
+        self.incoming = asyncio.Queue()
+        self.pending = {}
+        self.timer = None
+        self.timer_when = None
+        self.closed = False
+
+    @classmethod
+    async def create(cls, **kwargs):
+        '''create a BlockSender with the given keyword arguments and start
+        servicing it on the running event loop'''
+        link = cls(block_sender.BlockSender(**kwargs), loop=asyncio.get_running_loop())
+        await link.connect()
+        return link
+
+    async def connect(self):
+        '''register the sender's socket with the event loop'''
+        (self.transport, protocol) = await self.loop.create_datagram_endpoint(
+            lambda: BlockSenderProtocol(self), sock=self.sender.sock)
+        self._schedule(0)
+
+    def close(self):
+        '''stop servicing the sender and close its socket'''
+        self._set_closed()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def send(self, data, priority=0, **kwargs):
+        '''queue a data block. Returns a future that resolves to the block_id
+        once the whole block has been acknowledged, or raises
+        BlockSenderException if it passes its deadline first. Other keyword
+        arguments are passed to BlockSender.send()'''
+        future = self.loop.create_future()
+        def completed():
+            if not future.done():
+                future.set_result(block_id)
+        def expired():
+            if not future.done():
+                future.set_exception(block_sender.BlockSenderException('block %u expired' % block_id))
+        block_id = self.sender.send(data, priority=priority, callback=completed,
+                                    expired_callback=expired, **kwargs)
+        self.pending[block_id] = future
+        future.add_done_callback(lambda f: self.pending.pop(block_id, None))
+        self._schedule(0)
+        return future
+
+    async def recv(self):
+        '''wait for the next completed incoming block and return its data, or
+        None once the link is closed'''
+        data = await self.incoming.get()
+        if data is _CLOSED:
+            # leave it for any other readers
+            self.incoming.put_nowait(_CLOSED)
+            return None
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.recv()
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+    def _set_closed(self):
+        '''mark the link closed and wake anything waiting for a block'''
+        if not self.closed:
+            self.closed = True
+            self.incoming.put_nowait(_CLOSED)
+
+    def _packet_received(self, data, addr):
+        '''process one datagram from the event loop'''
+        with self.sender.lock:
+            self.sender._process_packet(memoryview(data), addr)
+        # let a burst of packets arrive before sending acks
+        self._schedule(0)
+
+    def _connection_lost(self, exc):
+        '''the socket was closed'''
+        self._set_closed()
+        for future in list(self.pending.values()):
+            if not future.done():
+                future.set_exception(block_sender.BlockSenderException('connection lost'))
+
+    def _schedule(self, delay):
+        '''make sure _service() runs within delay seconds'''
+        if self.closed:
+            return
+        when = self.loop.time() + delay
+        if self.timer is not None:
+            if self.timer_when <= when:
+                return
+            self.timer.cancel()
+        self.timer_when = when
+        self.timer = self.loop.call_at(when, self._service)
+
+    def _service(self):
+        '''send acks and any outgoing data that is due, deliver completed blocks
+        and schedule the next run'''
+        self.timer = None
+        sender = self.sender
+        with sender.lock:
+            # packets arrive through _packet_received(), not the socket
+            sender.tick(packet_count=0)
+            while True:
+                blk = sender._pop_completed(sender.ordered)
+                if blk is None:
+                    break
+                self.incoming.put_nowait(blk.data)
+            delay = sender._next_send_delay()
+        self._schedule(delay)
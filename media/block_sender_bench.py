@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''benchmark block_sender
+
+By default, for each send_mode this pushes a fixed amount of data from
+one BlockSender to another over the loopback interface and reports the
+packet rate and the CPU time per MB of payload. The CPU time covers both
+the sender and the receiver, as they run in the same process.
+
+With --emulate it instead sweeps an emulated link (see block_sender_emu)
+over the given loss rates, bandwidths, chunk sizes, backlogs and retransmit
+timeout multipliers, and reports the goodput, the efficiency (payload bytes
+over bytes sent), percentiles of the block completion latency and the
+number of blocks delivered with the wrong contents. The transfers are
+simulated in virtual time, so a sweep runs faster than real time and gives
+the same results for the same --seed. With --compression the blocks are
+compressible telemetry text instead of random bytes, for example
+
+    block_sender_bench.py --emulate --fec 4 --compression zlib --losses 0.3 --emu-block-size 2000 --blocks 40
+
+checks that compressed blocks rebuilt from parity come out intact.
+'''
+
+import os, time, random
+import block_sender, block_sender_emu
+
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    # python2, where time.clock() is the CPU time on unix
+    process_time = time.clock
+
+
+def bench_send_mode(send_mode, total_bytes, block_size, chunk_size, bandwidth):
+    '''transfer total_bytes in blocks of block_size using send_mode.
+    Return a dict of results'''
+    receiver = block_sender.BlockSender(port=0, dest_ip='127.0.0.1', bandwidth=bandwidth,
+                                        chunk_size=chunk_size, rcvbuf=8*1024*1024)
+    sender = block_sender.BlockSender(port=0, dest_ip='127.0.0.1', dest_port=receiver.get_port(),
+                                      bandwidth=bandwidth, chunk_size=chunk_size,
+                                      backlog=1000, send_mode=send_mode)
+    receiver.set_dest_port(sender.get_port())
+    data = os.urandom(block_size)
+    nblocks = max(1, total_bytes // block_size)
+    for i in range(nblocks):
+        sender.send(data, block_id=i+1)
+
+    received = 0
+    t0 = time.time()
+    c0 = process_time()
+    while received < nblocks and time.time() - t0 < 60:
+        sender.tick()
+        receiver.tick()
+        while receiver.available() is not None:
+            received += 1
+    cpu = process_time() - c0
+    elapsed = time.time() - t0
+    mbytes = nblocks * block_size / 1.0e6
+    return {'send_mode' : send_mode,
+            'batched' : sender.batch_sender is not None,
+            'complete' : received == nblocks,
+            'packets' : sender.send_count,
+            'elapsed' : elapsed,
+            'pps' : sender.send_count / elapsed,
+            'cpu_per_mb' : cpu / mbytes}
+
+
+def percentile(values, p):
+    '''return the p'th percentile of a list of values'''
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(round((p / 100.0) * (len(values) - 1)))]
+
+
+def telemetry(size, rng):
+    '''return size bytes of compressible telemetry like text'''
+    lines = []
+    length = 0
+    while length < size:
+        line = 'lat=%.6f lon=%.6f alt=%.1f\n' % (rng.uniform(-90, 90), rng.uniform(-180, 180),
+                                                 rng.uniform(0, 500))
+        lines.append(line)
+        length += len(line)
+    return bytearray(''.join(lines)[:size].encode('ascii'))
+
+
+def bench_emulated(loss, bandwidth, chunk_size, backlog, rtt_multiplier, delay=0.05, burst=1.0,
+                   block_size=20000, nblocks=20, load=0.8, seed=1, timeout=300, fec=0,
+                   compression=None):
+    '''send nblocks of block_size over an emulated link of bandwidth bytes/s with
+    an average loss rate of loss, in bursts of burst packets on average. Blocks
+    are offered at load times the link bandwidth. The transfer is simulated in
+    virtual time, timeout being in simulated seconds. fec and compression are
+    passed to the sender, with compression the blocks are telemetry text.
+    Return a dict of results'''
+    sim = block_sender_emu.Simulation(seed=seed)
+    air = ('10.7.7.2', 7000)
+    ground = ('10.7.7.1', 6000)
+    if burst > 1 and loss > 0:
+        # a Gilbert-Elliott chain spending loss of its time in the lossy state
+        p_good = 1.0 / burst
+        link = block_sender_emu.EmulatedLink(bandwidth=bandwidth, delay=delay, jitter=0.1*delay,
+                                             p_good=p_good, p_bad=loss * p_good / (1 - loss))
+    else:
+        link = block_sender_emu.EmulatedLink(bandwidth=bandwidth, delay=delay, jitter=0.1*delay,
+                                             loss=loss)
+    sim.connect(air, ground, link)
+    # leave room on the link for the IP and UDP headers
+    send_bandwidth = int(bandwidth * chunk_size / float(chunk_size + 64))
+    sender = sim.sender(air, ground, bandwidth=send_bandwidth, chunk_size=chunk_size,
+                        backlog=backlog, rtt=2*delay, fec=fec, compression=compression)
+    sender.rtt_multiplier = rtt_multiplier
+    receiver = sim.sender(ground, air, bandwidth=bandwidth, chunk_size=chunk_size)
+    if compression is not None:
+        data = telemetry(block_size, random.Random(seed))
+    else:
+        data = random.Random(seed).getrandbits(8*block_size)
+        data = bytearray((data >> (8*i)) & 0xFF for i in range(block_size))
+
+    interval = block_size / (load * bandwidth)
+    queued = {}
+    latency = []
+    def completed(block_id):
+        latency.append(sim.clock() - queued[block_id])
+    t0 = sim.clock()
+    state = { 'next_block' : 0, 'tlast' : t0, 'corrupt' : 0 }
+    def offer():
+        '''queue the blocks that are due and collect delivered ones. Returns
+        True once every block has been acked'''
+        tnow = sim.clock()
+        while state['next_block'] < nblocks and tnow >= t0 + state['next_block'] * interval:
+            state['next_block'] += 1
+            block_id = state['next_block']
+            queued[block_id] = tnow
+            sender.send(data, block_id=block_id, callback=lambda block_id=block_id: completed(block_id))
+        while True:
+            blk = receiver.available()
+            if blk is None:
+                break
+            if blk != data:
+                state['corrupt'] += 1
+            state['tlast'] = tnow
+        return len(latency) == nblocks
+    sim.run(until=t0 + timeout, condition=offer)
+    elapsed = max(state['tlast'] - t0, 1.0e-6)
+    stats = sender.get_stats()
+    wire_bytes = sum(stats['bytes_sent'].values())
+    return {'loss' : loss, 'bandwidth' : bandwidth, 'chunk_size' : chunk_size,
+            'backlog' : backlog, 'rtt_multiplier' : rtt_multiplier,
+            'complete' : len(latency) == nblocks,
+            'goodput' : len(latency) * block_size / elapsed,
+            'efficiency' : len(latency) * block_size / float(max(wire_bytes, 1)),
+            'retransmits' : stats['retransmits'],
+            'corrupt' : state['corrupt'],
+            'p50' : percentile(latency, 50),
+            'p90' : percentile(latency, 90),
+            'p99' : percentile(latency, 99)}
+
+
+def sweep(opts):
+    '''run bench_emulated() over every combination of the swept parameters'''
+    def values(s, type):
+        return [type(v) for v in s.split(',')]
+    print("%-6s %9s %6s %7s %5s %-8s %10s %6s %7s %8s %8s %8s %7s" % (
+        'loss', 'bandwidth', 'chunk', 'backlog', 'rttx', 'complete', 'goodput', 'eff',
+        'resends', 'p50', 'p90', 'p99', 'corrupt'))
+    for loss in values(opts.losses, float):
+        for bandwidth in values(opts.bandwidths, int):
+            for chunk_size in values(opts.chunk_sizes or str(opts.chunk_size), int):
+                for backlog in values(opts.backlogs, int):
+                    for rtt_multiplier in values(opts.rtt_multipliers, float):
+                        r = bench_emulated(loss, bandwidth, chunk_size, backlog, rtt_multiplier,
+                                           delay=opts.delay, burst=opts.burst,
+                                           block_size=opts.emu_block_size, nblocks=opts.blocks,
+                                           load=opts.load, seed=opts.seed, fec=opts.fec,
+                                           compression=opts.compression)
+                        print("%-6.3f %9u %6u %7u %5.1f %-8s %10.0f %6.3f %7u %8.3f %8.3f %8.3f %7u" % (
+                            r['loss'], r['bandwidth'], r['chunk_size'], r['backlog'],
+                            r['rtt_multiplier'], r['complete'], r['goodput'], r['efficiency'],
+                            r['retransmits'], r['p50'], r['p90'], r['p99'], r['corrupt']))
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser('block_sender_bench.py [options]')
+    parser.add_option("--total", type='int', default=20*1000*1000, help="bytes to send per mode")
+    parser.add_option("--block-size", type='int', default=1000*1000, help="block size")
+    parser.add_option("--chunk-size", type='int', default=1000, help="chunk size")
+    parser.add_option("--bandwidth", type='int', default=200*1000*1000, help="bandwidth limit in bytes/s")
+    parser.add_option("--modes", default='single,gso', help="comma separated send modes")
+    parser.add_option("--emulate", action='store_true', default=False,
+                      help="sweep an emulated link instead of benchmarking send modes")
+    parser.add_option("--losses", default='0,0.01,0.05,0.1', help="comma separated loss rates to sweep")
+    parser.add_option("--bandwidths", default='200000,1000000', help="comma separated link bandwidths to sweep")
+    parser.add_option("--chunk-sizes", default=None, help="comma separated chunk sizes to sweep (default --chunk-size)")
+    parser.add_option("--backlogs", default='100', help="comma separated backlogs to sweep")
+    parser.add_option("--rtt-multipliers", default='3', help="comma separated retransmit timeout multipliers to sweep")
+    parser.add_option("--delay", type='float', default=0.05, help="emulated one way delay in seconds")
+    parser.add_option("--burst", type='float', default=1.0, help="mean emulated loss burst length in packets")
+    parser.add_option("--emu-block-size", type='int', default=20000, help="block size for --emulate")
+    parser.add_option("--blocks", type='int', default=20, help="blocks to send per point for --emulate")
+    parser.add_option("--load", type='float', default=0.8, help="offered load as a fraction of the link bandwidth")
+    parser.add_option("--seed", type='int', default=1, help="random seed for --emulate")
+    parser.add_option("--fec", type='int', default=0, help="parity group size for --emulate")
+    parser.add_option("--compression", default=None, help="compression codec for --emulate")
+    (opts, args) = parser.parse_args()
+
+    if opts.emulate:
+        sweep(opts)
+        raise SystemExit(0)
+
+    print("%-8s %-8s %-8s %10s %10s %12s" % ('mode', 'batched', 'complete', 'packets', 'pkts/s', 'cpu s/MB'))
+    for mode in opts.modes.split(','):
+        r = bench_send_mode(mode, opts.total, opts.block_size, opts.chunk_size, opts.bandwidth)
+        print("%-8s %-8s %-8s %10u %10.0f %12.5f" % (r['send_mode'], r['batched'], r['complete'],
+                                                     r['packets'], r['pps'], r['cpu_per_mb']))
@@ -27,9 +27,8 @@ class BState(object):
         self.control_link_out.srcSystem = 122
         self.control_link_out.srcComponent = 254
 	
-	self.block_timeout = 10. #seconds (-1 = inf)
+	self.block_timeout = 10. #seconds without acks before the unsent blocks are dropped (-1 = inf)
 	self.idle_timeout = 2.
-        self.block_time = time.time()
 	self.recv_count = 0
 	self.send_count = 0
 	self.send_timer = time.time()
@@ -164,15 +163,24 @@ class Blocker(object):
           
     def send_blocks(self):
         state = self.state
-	state.block_time = time.time()
 	state.recv_count = 0
 	state.send_count = 0
+        # stale imagery is dropped by the block sender rather than sent late
+        deadline = None
+        if state.block_timeout != -1:
+            deadline = time.time() + state.block_timeout
+        expired = []
+        block_names = []
     
         while len(state.processed_block_list) > 0:
             processed_block = state.processed_block_list.pop(0)
+            block_name = processed_block.meta['block_name']
+            block_names.append(block_name)
             state.block_connetion.send(processed_block.data, 
-                                       block_id = processed_block.meta['block_name'],
-                                       priority = processed_block.meta['priority']
+                                       block_id = block_name,
+                                       priority = processed_block.meta['priority'],
+                                       deadline = deadline,
+                                       expired_callback = lambda block_name=block_name: expired.append(block_name)
                                        ) #send the blocks to the other device
             
         while state.block_connetion.sendq_size() > 0:
@@ -180,16 +188,16 @@ class Blocker(object):
 	    #print state.block_connetion.recv_count, state.block_connetion.send_count
 	    if state.block_connetion.recv_count != state.recv_count:
 	        state.recv_count = state.block_connetion.recv_count
-		state.block_time = time.time()
+                # acks are still arriving, give the blocks more time
+                if deadline is not None and time.time() + state.block_timeout - deadline > 1:
+                    deadline = time.time() + state.block_timeout
+                    for block_name in block_names:
+                        state.block_connetion.set_deadline(block_name, deadline)
 
-	    if ((state.block_timeout!= -1) and (time.time()-state.block_time > state.block_timeout)):
-		for idx, blk in enumerate(state.block_connetion.outgoing):
-		    if blk.block_id == processed_block.meta['block_name']:
-		        state.block_connetion.outgoing.pop(idx)
-		print 'Block timeout...'
-		print ''		
-		return False
-	    #we want to bail out of the block is taking too long...
+	if len(expired) > 0:
+	    print 'Block timeout...', expired
+	    print ''
+	    return False
 
     def notify_send_complete(self):
         state = self.state
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''
+network emulator for block_sender
+
+EmulatedNetwork carries datagrams between EmulatedSocket objects in the
+same process, through EmulatedLink objects modelling a bandwidth cap,
+propagation delay and jitter, Gilbert-Elliott burst loss, reordering and
+duplication. All randomness comes from one seeded generator, so a run
+can be repeated exactly. The sockets can be given to BlockSender as sock=
+
+    net = EmulatedNetwork(seed=1)
+    air = ('10.7.7.2', 7000)
+    ground = ('10.7.7.1', 6000)
+    net.connect(air, ground, EmulatedLink(bandwidth=40000, delay=0.05, loss=0.01))
+    sender = block_sender.BlockSender(sock=net.socket(air), dest_ip=ground[0], dest_port=ground[1])
+    receiver = block_sender.BlockSender(sock=net.socket(ground), dest_ip=air[0], dest_port=air[1])
+
+The sockets have no file descriptor, so drive the senders with tick()
+or recv() with a zero timeout rather than start().
+
+Simulation runs BlockSenders on an EmulatedNetwork against a
+VirtualClock, jumping from one event to the next instead of waiting for
+them, so a long flight takes seconds to simulate and every run with the
+same seed gives the same result
+
+    sim = Simulation(seed=1)
+    sim.connect(air, ground, EmulatedLink(bandwidth=40000, delay=0.05, loss=0.01))
+    sender = sim.sender(air, ground)
+    receiver = sim.sender(ground, air)
+    sender.send(data)
+    sim.run(until=1800, condition=lambda: sender.sendq_size() == 0)
+'''
+
+import socket, errno, random, time, heapq, copy
+import block_sender
+
+
+class EmulatedLink:
+    '''one direction of an emulated link
+
+    bandwidth:     link rate in bytes/second, None for no limit (default None)
+    delay:         one way propagation delay in seconds (default 0)
+    jitter:        extra delay of each packet, uniform between 0 and jitter seconds.
+               Packets overtake each other when the jitter is larger than the gap
+               between them (default 0)
+    loss:          loss probability of a packet in the good state (default 0)
+    burst_loss:    loss probability of a packet in the bad state (default 1)
+    p_bad:         probability per packet of moving from the good to the bad state.
+               Zero gives independent losses with probability loss (default 0)
+    p_good:        probability per packet of moving from the bad to the good state, one
+               over the mean burst length (default 0.5)
+    reorder:       probability of holding a packet back by reorder_delay (default 0)
+    reorder_delay: seconds a reordered packet is held back (default 0.01)
+    duplicate:     probability of delivering a packet twice (default 0)
+    queue_size:    bytes that can wait for the link, packets arriving at a full
+               queue are dropped. None for no limit (default None)
+    overhead:      IP and UDP header bytes counted against the bandwidth for each
+               packet (default 28)
+    '''
+    def __init__(self, bandwidth=None, delay=0, jitter=0, loss=0, burst_loss=1.0, p_bad=0,
+                 p_good=0.5, reorder=0, reorder_delay=0.01, duplicate=0, queue_size=None,
+                 overhead=28):
+        self.bandwidth = bandwidth
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.burst_loss = burst_loss
+        self.p_bad = p_bad
+        self.p_good = p_good
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.queue_size = queue_size
+        self.overhead = overhead
+        # set by EmulatedNetwork.connect()
+        self.rng = random.Random()
+        self.bad = False
+        # when the packets already sent will have left the link
+        self.busy_until = 0
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0
+        self.dropped = 0
+        self.duplicated = 0
+
+    def __str__(self):
+        return 'EmulatedLink<packets=%u lost=%u dropped=%u duplicated=%u>' % (
+            self.packets, self.lost, self.dropped, self.duplicated)
+
+    def transmit(self, size, tnow):
+        '''send a packet of size bytes at time tnow. Return a list of the
+        times it arrives at, empty if it is lost'''
+        rng = self.rng
+        self.packets += 1
+        self.bytes += size
+        t = tnow
+        if self.bandwidth:
+            start = max(tnow, self.busy_until)
+            if self.queue_size is not None and (start - tnow) * self.bandwidth > self.queue_size:
+                self.dropped += 1
+                return []
+            self.busy_until = start + (size + self.overhead) / float(self.bandwidth)
+            t = self.busy_until
+
+        # Gilbert-Elliott two state loss
+        if self.bad:
+            if rng.random() < self.p_good:
+                self.bad = False
+        elif self.p_bad and rng.random() < self.p_bad:
+            self.bad = True
+        if self.bad:
+            loss = self.burst_loss
+        else:
+            loss = self.loss
+        if loss and rng.random() < loss:
+            self.lost += 1
+            return []
+
+        t += self.delay
+        if self.jitter:
+            t += rng.uniform(0, self.jitter)
+        if self.reorder and rng.random() < self.reorder:
+            t += self.reorder_delay
+        times = [t]
+        if self.duplicate and rng.random() < self.duplicate:
+            self.duplicated += 1
+            times.append(t + rng.uniform(0, self.jitter))
+        return times
+
+
+class EmulatedSocket:
+    '''a non-blocking UDP socket on an EmulatedNetwork, see EmulatedNetwork.socket()'''
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+        # heap of (arrival_time, seq, data, fromaddr)
+        self.inbox = []
+
+    def getsockname(self):
+        return self.addr
+
+    def setblocking(self, flag):
+        pass
+
+    def sendto(self, data, dest):
+        '''send a datagram'''
+        self.network._deliver(self.addr, tuple(dest), bytes(data))
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        '''return (data, fromaddr) for the next datagram that has arrived, or
+        raise socket.error with EAGAIN if there is none yet'''
+        inbox = self.inbox
+        if not inbox or inbox[0][0] > self.network.clock():
+            raise socket.error(errno.EAGAIN, 'no datagram ready')
+        (t, seq, data, fromaddr) = heapq.heappop(inbox)
+        return (data[:bufsize], fromaddr)
+
+    def recvfrom_into(self, buffer, nbytes=0):
+        '''receive a datagram into buffer, returning (nbytes, fromaddr)'''
+        if nbytes == 0:
+            nbytes = len(buffer)
+        (data, fromaddr) = self.recvfrom(nbytes)
+        buffer[:len(data)] = data
+        return (len(data), fromaddr)
+
+    def next_arrival(self):
+        '''return the time the next datagram arrives, or None'''
+        if not self.inbox:
+            return None
+        return self.inbox[0][0]
+
+    def close(self):
+        self.network.sockets.pop(self.addr, None)
+        self.inbox = []
+
+
+class EmulatedNetwork:
+    '''a set of EmulatedSockets joined by EmulatedLinks
+
+    seed:  seed for the random numbers used by all links (default None, random)
+    clock: function returning the current time (default time.time)
+
+    Datagrams between addresses with no link are delivered at once, and
+    datagrams to an address with no socket are dropped'''
+    def __init__(self, seed=None, clock=time.time):
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.sockets = {}
+        # (source, destination) -> EmulatedLink
+        self.links = {}
+        self.seq = 0
+
+    def socket(self, addr):
+        '''return a new socket bound to the (host,port) tuple addr'''
+        addr = tuple(addr)
+        sock = EmulatedSocket(self, addr)
+        self.sockets[addr] = sock
+        return sock
+
+    def connect(self, a, b, link, reverse=None):
+        '''join addresses a and b with link carrying datagrams from a to b, and
+        reverse from b to a (default a copy of link)'''
+        (a, b) = (tuple(a), tuple(b))
+        if reverse is None:
+            reverse = copy.copy(link)
+        for (key, l) in [((a, b), link), ((b, a), reverse)]:
+            # a generator per link keeps each one repeatable on its own
+            l.rng = random.Random(self.rng.getrandbits(64))
+            self.links[key] = l
+
+    def link(self, a, b):
+        '''return the link from a to b, or None'''
+        return self.links.get((tuple(a), tuple(b)), None)
+
+    def next_arrival(self):
+        '''return the time the next datagram arrives at any socket, or None'''
+        times = [t for t in [s.next_arrival() for s in self.sockets.values()] if t is not None]
+        if not times:
+            return None
+        return min(times)
+
+    def _deliver(self, src, dest, data):
+        '''carry a datagram from src to dest'''
+        sock = self.sockets.get(dest, None)
+        if sock is None:
+            return
+        tnow = self.clock()
+        link = self.links.get((src, dest), None)
+        if link is None:
+            times = [tnow]
+        else:
+            times = link.transmit(len(data), tnow)
+        for t in times:
+            heapq.heappush(sock.inbox, (t, self.seq, data, src))
+            self.seq += 1
+
+
+class VirtualClock:
+    '''a clock for simulations that only moves when it is advanced. Call it
+    to read the time'''
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, t):
+        '''move the clock forward to time t'''
+        if t > self.now:
+            self.now = t
+
+
+class Simulation:
+    '''a discrete event simulation of BlockSenders on an EmulatedNetwork
+
+    seed:     seed for the network and the senders (default None, random)
+    start:    virtual time to start at (default 0)
+    min_step: smallest step the clock takes, so that a sender with work
+              due now can't stall the simulation (default 1e-6 seconds)
+    '''
+    def __init__(self, seed=None, start=0.0, min_step=1.0e-6):
+        self.clock = VirtualClock(start)
+        self.network = EmulatedNetwork(seed=seed, clock=self.clock)
+        self.rng = random.Random(seed)
+        self.seeded = seed is not None
+        self.min_step = min_step
+        self.senders = []
+        self.steps = 0
+
+    def connect(self, a, b, link, reverse=None):
+        '''join addresses a and b, see EmulatedNetwork.connect()'''
+        self.network.connect(a, b, link, reverse)
+
+    def sender(self, addr, dest, **kwargs):
+        '''return a new BlockSender at address addr sending to dest. Other
+        keyword arguments are passed to BlockSender'''
+        if self.seeded:
+            kwargs.setdefault('seed', self.rng.getrandbits(32))
+        sender = block_sender.BlockSender(sock=self.network.socket(addr), port=addr[1],
+                                          dest_ip=dest[0], dest_port=dest[1],
+                                          clock=self.clock, **kwargs)
+        self.add(sender)
+        return sender
+
+    def add(self, sender):
+        '''add a BlockSender created elsewhere. It must use this simulation's
+        clock, and sockets from its network'''
+        self.senders.append(sender)
+
+    def step(self):
+        '''tick every sender, then advance the clock to the next event.
+        Returns the new time'''
+        for sender in self.senders:
+            sender.tick()
+        events = [s.next_event_time() for s in self.senders]
+        arrival = self.network.next_arrival()
+        if arrival is not None:
+            events.append(arrival)
+        tnext = self.clock() + self.min_step
+        if events:
+            tnext = max(min(events), tnext)
+        self.clock.advance(tnext)
+        self.steps += 1
+        return self.clock()
+
+    def run(self, until=None, condition=None):
+        '''step the simulation until the clock reaches until or condition()
+        returns True, whichever comes first. Returns the time'''
+        while until is None or self.clock() < until:
+            if condition is not None and condition():
+                break
+            self.step()
+        return self.clock()
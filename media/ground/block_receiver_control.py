@@ -23,6 +23,7 @@ class BState(object):
         packet_loss = False
         backlog=100
         chunk_size=1000 #max = 65535
+        rcvbuf = 4*1024*1024 #absorb bursts while we are busy
         dest_ip = '10.7.7.2'
         listen_ip = '10.7.7.1'
         # setup a send/recv pair
@@ -32,7 +33,7 @@ class BState(object):
                                                         port =6000,
                                                         debug=debug, bandwidth=bandwidth,
                                                         ordered=ordered, chunk_size=chunk_size,
-                                                        backlog=backlog)
+                                                        backlog=backlog, rcvbuf=rcvbuf)
 
         if packet_loss:
             self.block_connetion.set_packet_loss(packet_loss)
@@ -41,7 +42,6 @@ class BState(object):
         self.raw_block_list  = []
         self.processed_block_list = []
         self.status_history = []
-        self.completed_history = []
         self.thread_list = []
        
         
@@ -79,22 +79,21 @@ class Blocker(object):
         
         
 
-        blk = state.block_connetion.recv(0.01)
-#         if blk is not None:
-#             received1.append(blk)
+        block = state.block_connetion.recv_block(0.01)
 
         state.block_connetion.tick()
         
-        for ID, DATA in state.block_connetion.completed2:
-            if ID not in state.completed_history:
- 
-                #add id to history
-                state.completed_history.append(ID)
-                print "comp:",  [(ID >> i & 0xff) for i in (16,8,0)]
-                 
-                state.thread_list.append(threading.Thread(target=write_image, args=(DATA,ID)))
-                state.thread_list[-1].setDaemon(True)
-                state.thread_list[-1].start()
+        #forget image writer threads that have finished
+        state.thread_list = [t for t in state.thread_list if t.is_alive()]
+        while block is not None:
+            #each completed block is handed out once
+            (ID, DATA) = block
+            print "comp:",  [(ID >> i & 0xff) for i in (16,8,0)]
+             
+            state.thread_list.append(threading.Thread(target=write_image, args=(DATA,ID)))
+            state.thread_list[-1].setDaemon(True)
+            state.thread_list[-1].start()
+            block = state.block_connetion.available_block()
                 
                 
 
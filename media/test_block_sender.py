@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+'''
+tests for block_sender, run with
+
+    python -m unittest test_block_sender
+
+from the media directory. Transfers run on a block_sender_emu Simulation
+with a fixed seed, so they are repeatable and take little real time
+'''
+
+import unittest, random, tempfile, shutil, os, json
+import block_sender, block_sender_emu
+
+AIR = ('10.7.7.2', 7000)
+GROUND = ('10.7.7.1', 6000)
+
+
+def payload(size, seed):
+    '''return size bytes of repeatable random data'''
+    rng = random.Random(seed)
+    return bytearray(rng.getrandbits(8) for i in range(size))
+
+
+def text(size, seed):
+    '''return size bytes of repeatable data that compresses about 2:1'''
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        data += b'%x ' % rng.getrandbits(16)
+    return data[:size]
+
+
+class Transfer:
+    '''a sender and receiver joined by an emulated link'''
+    def __init__(self, seed=1, bandwidth=100000, delay=0.02, loss=0, sender_args={},
+                 receiver_args={}, **link_args):
+        self.sim = block_sender_emu.Simulation(seed=seed)
+        self.link = block_sender_emu.EmulatedLink(bandwidth=bandwidth, delay=delay, loss=loss,
+                                                  **link_args)
+        self.sim.connect(AIR, GROUND, self.link)
+        sender_args = dict(sender_args)
+        sender_args.setdefault('bandwidth', bandwidth)
+        receiver_args = dict(receiver_args)
+        receiver_args.setdefault('bandwidth', bandwidth)
+        self.sender = self.sim.sender(AIR, GROUND, **sender_args)
+        self.receiver = self.sim.sender(GROUND, AIR, **receiver_args)
+        # block_id -> data delivered to the receiver
+        self.received = {}
+
+    def collect(self):
+        '''collect the blocks the receiver has completed'''
+        while True:
+            block = self.receiver.available_block()
+            if block is None:
+                break
+            self.received[block[0]] = block[1]
+
+    def run(self, until=600, condition=None):
+        '''run until the send queue is empty and, if given, condition() is
+        True. Returns the simulated time taken'''
+        t0 = self.sim.clock()
+        def done():
+            self.collect()
+            if condition is not None:
+                return condition()
+            return self.sender.sendq_size() == 0
+        self.sim.run(until=t0 + until, condition=done)
+        self.collect()
+        return self.sim.clock() - t0
+
+
+class RateControlTest(unittest.TestCase):
+    def send_blocks(self, rate_control, seed):
+        t = Transfer(seed=seed, delay=0.06, loss=0.1, sender_args={'rate_control' : rate_control})
+        blocks = dict([(i + 1, payload(25000, seed * 100 + i)) for i in range(20)])
+        for (block_id, data) in blocks.items():
+            t.sender.send(data, block_id=block_id)
+        elapsed = t.run()
+        self.assertEqual(t.received, blocks)
+        return (elapsed, t)
+
+    def test_delay_rate_control_holds_rate_under_loss(self):
+        '''random loss and re-acks of completed blocks must not be taken for
+        queueing delay'''
+        for seed in range(1, 6):
+            (fixed, t) = self.send_blocks(block_sender.FixedRateControl(), seed)
+            (delay, t) = self.send_blocks(block_sender.DelayRateControl(), seed)
+            self.assertLess(delay, 1.5 * fixed)
+            base_rtt = min(t.sender.paths[0].rate_control.base_rtt)
+            self.assertGreater(base_rtt, 0.12)
+
+    def test_fixed_rate_control(self):
+        '''a fixed rate sender on a clean link runs at its configured rate'''
+        t = Transfer(bandwidth=50000, delay=0.05)
+        data = payload(200000, 1)
+        t.sender.send(data, block_id=1)
+        elapsed = t.run()
+        self.assertEqual(t.received, {1 : data})
+        wire = t.sender.get_stats()['bytes_sent']['chunk'] / float(elapsed)
+        # less a round trip at the end
+        self.assertGreater(wire, 0.85 * 50000)
+        self.assertLess(wire, 1.05 * 50000)
+
+    def test_delay_rate_control_backs_off(self):
+        '''a sender faster than the link builds a queue and slows down'''
+        t = Transfer(bandwidth=50000, delay=0.05,
+                     sender_args={'bandwidth' : 200000, 'rate_control' : block_sender.DelayRateControl()})
+        for i in range(10):
+            t.sender.send(payload(50000, i), block_id=i + 1)
+        t.run(until=5, condition=lambda: False)
+        self.assertLess(t.sender.get_send_rate(), 100000)
+
+    def test_no_early_resends_on_slow_link(self):
+        '''chunks are not resent while the first acks are on their way, and
+        a block finishes about one round trip after its last chunk is sent'''
+        for (size, bandwidth) in [(5000, 20000), (50000, 100000), (20000, 18000)]:
+            t = Transfer(bandwidth=bandwidth, delay=0.05)
+            done = []
+            t.sender.send(payload(size, 1), block_id=1, callback=lambda: done.append(t.sim.clock()))
+            t.run()
+            self.assertEqual(t.sender.get_stats()['retransmits'], 0)
+            # a chunk is sent every chunk time from the first, then a round
+            # trip and an ack delay for the last one
+            chunks = len(t.received[1]) // t.sender.chunk_size + 1
+            chunk_time = (t.sender.chunk_size + t.sender.chunk_overhead + block_sender.PACKET_HEADER_SIZE) / float(bandwidth)
+            self.assertLess(done[0], (chunks + 1) * chunk_time + 0.1 + 0.05)
+
+    def test_rate_is_a_pure_read(self):
+        '''asking for the rate or the stats does not move the controller'''
+        t = Transfer(delay=0.05, sender_args={'rate_control' : block_sender.DelayRateControl()})
+        t.sender.send(payload(50000, 1), block_id=1)
+        t.run()
+        control = t.sender.paths[0].rate_control
+        state = dict(control.__dict__)
+        t.sim.clock.advance(t.sim.clock() + 10)
+        for i in range(3):
+            t.sender.get_send_rate()
+            t.sender.get_stats()
+        self.assertEqual(control.__dict__, state)
+
+
+class AckFormatTest(unittest.TestCase):
+    def send_blocks(self, **receiver_args):
+        t = Transfer(delay=0.03, loss=0.05, reorder=0.05, receiver_args=receiver_args)
+        blocks = dict([(i + 1, payload(30000, i)) for i in range(10)])
+        for (block_id, data) in blocks.items():
+            t.sender.send(data, block_id=block_id)
+        t.run()
+        self.assertEqual(t.received, blocks)
+        # packet type name -> count, without types never sent
+        return t.receiver.get_stats()['packets_sent']
+
+    def test_extents(self):
+        sent = self.send_blocks(ack_format='extents')
+        self.assertGreater(sent.get('ack', 0), 0)
+        self.assertEqual(sent.get('sack', 0), 0)
+
+    def test_bitmap(self):
+        sent = self.send_blocks(ack_format='bitmap')
+        self.assertGreater(sent.get('sack', 0), 0)
+
+    def test_auto(self):
+        '''auto picks whichever encoding is smaller for each ack'''
+        sent = self.send_blocks(ack_format='auto')
+        self.assertGreater(sent.get('ack', 0), 0)
+        self.assertGreater(sent.get('sack', 0), 0)
+
+    def test_delayed_acks(self):
+        '''acks held for ack_delay cover more chunks, so fewer are sent'''
+        immediate = self.send_blocks()
+        delayed = self.send_blocks(ack_delay=0.02, multi_ack=True)
+        self.assertLess(delayed.get('ack', 0) + delayed.get('multi', 0), immediate['ack'])
+
+
+class FecTest(unittest.TestCase):
+    def send_blocks(self, **sender_args):
+        t = Transfer(delay=0.05, loss=0.05, sender_args=sender_args)
+        blocks = dict([(i + 1, payload(20000, i)) for i in range(10)])
+        for (block_id, data) in blocks.items():
+            t.sender.send(data, block_id=block_id)
+        t.run()
+        self.assertEqual(t.received, blocks)
+        return t.receiver.get_stats()
+
+    def test_recovery(self):
+        '''lost chunks are rebuilt from parity'''
+        self.assertEqual(self.send_blocks()['recovered_chunks'], 0)
+        self.assertGreater(self.send_blocks(fec=4)['recovered_chunks'], 0)
+
+    def test_compressed(self):
+        '''chunks recovered from parity of a compressed block decompress'''
+        t = Transfer(delay=0.05, loss=0.05, sender_args={'fec' : 4})
+        blocks = dict([(i + 1, text(30000, i)) for i in range(10)])
+        for (block_id, data) in blocks.items():
+            t.sender.send(data, block_id=block_id, compression='zlib')
+        t.run()
+        self.assertEqual(t.received, blocks)
+        self.assertGreater(t.receiver.get_stats()['recovered_chunks'], 0)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_expiry(self):
+        '''a block not done by its deadline is dropped at both ends, and the
+        blocks behind it still arrive'''
+        t = Transfer(bandwidth=20000, delay=0.05)
+        expired = []
+        late = payload(50000, 1)
+        t.sender.send(late, block_id=1, priority=1, deadline=t.sim.clock() + 1,
+                      expired_callback=lambda: expired.append(t.sim.clock()))
+        data = payload(5000, 2)
+        t.sender.send(data, block_id=2)
+        t.run()
+        self.assertEqual(t.received, {2 : data})
+        self.assertEqual(len(expired), 1)
+        self.assertLess(expired[0], 1.1)
+        self.assertEqual(t.sender.get_stats()['blocks_expired'], 1)
+        self.assertEqual(len(t.receiver.incoming_ids), 0)
+
+    def test_earliest_deadline_first(self):
+        '''among blocks of equal priority the earliest deadline goes first'''
+        t = Transfer(bandwidth=50000)
+        order = []
+        now = t.sim.clock()
+        for (block_id, deadline) in [(1, None), (2, now + 30), (3, now + 10)]:
+            t.sender.send(payload(10000, block_id), block_id=block_id, deadline=deadline,
+                          callback=lambda block_id=block_id: order.append(block_id))
+        t.run()
+        self.assertEqual(order, [3, 2, 1])
+
+    def test_cancel(self):
+        '''a cancelled block is dropped by the receiver'''
+        t = Transfer(bandwidth=20000, delay=0.05)
+        t.sender.send(payload(50000, 1), block_id=1)
+        t.run(until=0.5, condition=lambda: False)
+        self.assertTrue(t.sender.cancel(1))
+        t.run(until=1, condition=lambda: False)
+        self.assertEqual(t.received, {})
+        self.assertEqual(len(t.receiver.incoming_ids), 0)
+        data = payload(5000, 2)
+        t.sender.send(data, block_id=2)
+        t.run()
+        self.assertEqual(t.received, {2 : data})
+
+
+class PartialBatch:
+    '''a batch sender whose socket buffer fills after limit packets'''
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+
+    def send(self, packets):
+        for (parts, dest) in packets[:self.limit]:
+            self.path.sendto(parts, dest)
+        return min(len(packets), self.limit)
+
+
+class BatchSendTest(unittest.TestCase):
+    def send_burst(self, limit):
+        t = Transfer(delay=0.05)
+        t.sender.batch_sender = PartialBatch(t.sender.paths[0], limit)
+        # let the token bucket fill, so the first tick sends a burst
+        t.sim.clock.advance(1)
+        data = payload(100000, 1)
+        t.sender.send(data, block_id=1)
+        t.run()
+        self.assertEqual(t.received, {1 : data})
+        return t.sender.get_stats()
+
+    def test_partial_batch(self):
+        '''chunks a batched send could not send go out again without waiting
+        for their retransmit timer'''
+        full = self.send_burst(1000)
+        partial = self.send_burst(3)
+        self.assertEqual(full['send_errors'], 0)
+        self.assertGreater(partial['send_errors'], 0)
+        self.assertEqual(partial['retransmits'], full['retransmits'])
+        self.assertEqual(partial['chunks_sent'], full['chunks_sent'])
+
+
+class ReceiveTest(unittest.TestCase):
+    def test_bad_chunks_dropped(self):
+        '''chunks whose header does not fit the block are dropped, without
+        stopping the receiver'''
+        t = Transfer()
+        data = payload(10000, 1)
+        cs = t.sender.chunk_size
+        now = t.sim.clock()
+        bad = [block_sender.BlockSenderChunk(1, len(data), 50, bytearray(cs), cs, 0, now),
+               block_sender.BlockSenderChunk(1, len(data), 9, bytearray(2 * cs), cs, 0, now),
+               block_sender.BlockSenderChunk(1, len(data), 19, bytearray(cs // 2), cs // 2, 0, now),
+               block_sender.BlockSenderChunk(1, 2 * len(data), 15, bytearray(cs), cs, 0, now),
+               block_sender.BlockSenderChunk(2, len(data), 0, bytearray(0), 0, 0, now)]
+        for chunk in bad:
+            t.sender._send_object(chunk, chunk.packet_type(), None)
+        t.sender.send(data, block_id=1)
+        t.run()
+        self.assertEqual(t.received, {1 : data})
+        self.assertEqual(t.receiver.get_stats()['bad_packets'], len(bad))
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def header(self, name, **fields):
+        header = {'block_id' : 1, 'size' : 10000, 'chunk_size' : 1000, 'dest' : list(GROUND),
+                  'priority' : 0, 'codec' : 0, 'fec' : 0, 'deadline' : None}
+        header.update(fields)
+        self.write(name, json.dumps(header).encode('utf-8'))
+
+    def test_resume(self):
+        '''a sender restarted from its journal finishes its blocks without
+        sending again the chunks that were acked'''
+        t = Transfer(bandwidth=50000, delay=0.05, loss=0.02, sender_args={'journal_dir' : self.dir})
+        blocks = dict([(i + 1, payload(50000, i)) for i in range(3)])
+        for (block_id, data) in blocks.items():
+            t.sender.send(data, block_id=block_id)
+        t.run(until=2, condition=lambda: False)
+        t.sender.save_journal()
+        # a crash: the new sender only has the journal
+        t.sim.senders.remove(t.sender)
+        t.sender = t.sim.sender(AIR, GROUND, bandwidth=50000, journal_dir=self.dir)
+        self.assertEqual(t.sender.sendq_size(), len(blocks) - len(t.received))
+        unsent = sum([b.num_chunks for b in t.sender.outgoing_ids.values()])
+        acked = sum([b.acks.count for b in t.sender.outgoing_ids.values()])
+        self.assertGreater(acked, 0)
+        t.run()
+        self.assertEqual(t.received, blocks)
+        # some chunks were in flight, or lost, when the sender stopped
+        self.assertLess(t.sender.get_stats()['chunks_sent'], unsent - acked // 2)
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'out')), [])
+
+    def test_bad_entries_skipped(self):
+        '''journal entries that don't describe a usable block are not resumed'''
+        self.header('out/1.json', chunk_size=0)
+        self.header('out/2.json', block_id=2, size='10000')
+        self.header('out/3.json', block_id=3, deadline='soon')
+        self.write('out/4.json', b'[4]')
+        for i in range(1, 5):
+            self.write('out/%u.data' % i, bytes(bytearray(10000)))
+        self.header('in/5.json', block_id=5, codec=9)
+        self.header('in/6.json', block_id=6)
+        for i in (5, 6):
+            self.write('in/%u.map' % i, b'\xff\x03')
+        # shorter than the header says, the map can't be trusted
+        self.write('in/6.part', bytes(bytearray(5000)))
+        t = Transfer(sender_args={'journal_dir' : self.dir})
+        self.assertEqual(t.sender.sendq_size(), 0)
+        self.assertEqual(len(t.sender.incoming_ids), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'in', '6.json')))
+        data = payload(10000, 1)
+        t.sender.send(data, block_id=7)
+        t.run()
+        self.assertEqual(t.received, {7 : data})
+
+
+class StatsTest(unittest.TestCase):
+    def test_rtt_histogram(self):
+        '''every RTT sample, including from re-acks of delivered blocks, is at
+        least the round trip time of the link'''
+        t = Transfer(delay=0.06, loss=0.1)
+        for i in range(20):
+            t.sender.send(payload(25000, i), block_id=i + 1)
+        t.run()
+        self.assertEqual(len(t.received), 20)
+        rtt_hist = t.sender.get_stats()['rtt_hist']
+        for (bound, count) in zip(rtt_hist['bounds'], rtt_hist['counts']):
+            if bound < 0.12:
+                self.assertEqual(count, 0)
+        self.assertGreater(sum(rtt_hist['counts']), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()